@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+
+# Benchmark of the sequencer grammar parser over a tree of sequencer files.
+#
+# Changelog
+# 20261018: initialized to follow parsing speed of grammar.SeqParser.
+#
+# Syntax as main:
+# python benchgrammar.py [root directory] <[number of slowest files to list]>
+# Example:
+# python benchgrammar.py .. 10
+#
+# Syntax in a script:
+# import benchgrammar
+# benchgrammar.bench_tree("..")
+from __future__ import print_function
+import sys
+import os
+import time
+
+import grammar
+import seqcompiler
+
+
+def time_parse(seqfile):
+    """
+    Parses a single file, returns parsing time in seconds and whether parsing succeeded.
+    :param seqfile:
+    :return: tuple
+    """
+    start = time.time()
+    try:
+        result = grammar.parse_file(seqfile, verbose=False)
+        success = result is not None
+    except Exception:
+        success = False
+
+    return time.time() - start, success
+
+
+def bench_tree(rootdir, nslowest=10):
+    """
+    Parses all sequencer files under rootdir, prints total time and the slowest files.
+    The cache of included files is emptied before each file, so that every file is fully parsed.
+    :param rootdir:
+    :param nslowest: number of slowest files to list
+    :return: total time (s)
+    """
+    seqfiles = seqcompiler.find_seqfiles([rootdir])
+
+    timings = []
+    nbytes = 0
+    nfailed = 0
+    for f in seqfiles:
+        # parses includes again for each file, instead of timing cache hits
+        grammar.clear_include_cache()
+        t, success = time_parse(f)
+        timings.append((t, f))
+        nbytes += os.path.getsize(f)
+        if not success:
+            nfailed += 1
+
+    total = sum([t for t, f in timings])
+    print("Parsed %d files (%d failed, %.1f kB) in %.3f s" % (len(seqfiles), nfailed, nbytes / 1024., total))
+    if total > 0:
+        print("Throughput: %.1f kB/s" % (nbytes / 1024. / total))
+
+    for t, f in sorted(timings, reverse=True)[:nslowest]:
+        print("%8.2f ms  %s" % (t * 1e3, f))
+
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("benchgrammar.py requires a root directory")
+        sys.exit()
+    rootdir = sys.argv[1]
+    if len(sys.argv) > 2:
+        nslowest = int(sys.argv[2])
+    else:
+        nslowest = 10
+
+    bench_tree(rootdir, nslowest)
@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+#
+# LSST
+# Decompiler of compiled sequencer files (text .compiled or binary .seqbin) back to a Sequencer.
+#
+# Functions, program and pointers are rebuilt from the FPGA memory image, so that what is
+# loaded on the hardware can be timed and checked without the sequencer source file.
+# Names of functions, subroutines and pointers come from the file header and comments.
+# The clock period is not stored in text compiled files: it defaults to 10 ns.
+# Timings may differ from those computed from the source file where the FPGA memory does
+# not hold the source values: only the first slice of function #0 is stored, and slice
+# durations are truncated to 16 bits.
+#
+# Syntax as main:
+# python decompiler.py [compiled-file] <[Main or Subroutine]>
+# Example:
+# python decompiler.py seq-newflush.compiled Acquisition
+#
+# Syntax in a script:
+# import decompiler
+# seq = decompiler.Sequencer.fromcompiledfile("seq-newflush.compiled")
+# seq.timing("Acquisition")
+from __future__ import print_function
+import sys
+import re
+
+import bidi
+from sequencer import *
+import seqcompiler
+
+default_clockperiod = 10e-9
+
+pattern_word = re.compile(r"0x([0-9A-Fa-f]+):\s+0x([0-9A-Fa-f]+)(\s+#\s*(\w+):\s+(\S+))?")
+pattern_subroutine = re.compile(r"#\s+(\w+):\s+0x([0-9A-Fa-f]+)\s*$")
+pattern_function = re.compile(r"##\s+function:\s+#(\d+)")
+pattern_funcfield = re.compile(r"##\s+(name|description):\s(.*)$")
+pattern_source = re.compile(r"##\s+Source:\s+(.*)$")
+
+
+def read_compfile(compfile):
+    """
+    Reads a text compiled file written by seqcompiler.write_compfile().
+    Returns a header (same layout as in binary compiled files) and the memory image.
+    :param compfile:
+    :return: tuple (dict, MemoryImage)
+    """
+    header = {'source': '', 'subroutines': {}, 'functions': [], 'pointers': []}
+    outputs = np.zeros(256, dtype=np.uint32)
+    slices = np.zeros(256, dtype=np.uint32)
+    program = {}
+    pointers = []
+    function = None
+
+    with open(compfile) as f:
+        for line in f:
+            m = pattern_word.match(line)
+            if m is not None:
+                addr = int(m.group(1), 16)
+                value = int(m.group(2), 16)
+                base = addr & 0xff0000
+                if m.group(3):
+                    # pointer, with its type and name in comment
+                    pointers.append((addr, value))
+                    header['pointers'].append([m.group(5), m.group(4)])
+                elif base == MemoryImage.outputs_base_addr:
+                    outputs[addr & 0xff] = value
+                elif base == MemoryImage.slices_base_addr:
+                    slices[addr & 0xff] = value
+                elif base == MemoryImage.program_base_addr:
+                    program[addr & 0xffff] = value
+                else:
+                    raise ValueError('Unexpected address 0x%06x in %s' % (addr, compfile))
+                continue
+
+            m = pattern_function.match(line)
+            if m is not None:
+                function = [int(m.group(1)), '', '', None]
+                header['functions'].append(function)
+                continue
+
+            m = pattern_funcfield.match(line)
+            if m is not None and function is not None:
+                value = m.group(2).strip()
+                if value == 'None':
+                    value = None
+                if m.group(1) == 'name':
+                    function[1] = value
+                else:
+                    function[2] = value
+                continue
+
+            m = pattern_subroutine.match(line)
+            if m is not None:
+                header['subroutines'][m.group(1)] = int(m.group(2), 16)
+                continue
+
+            m = pattern_source.match(line)
+            if m is not None:
+                header['source'] = m.group(1).strip()
+
+    words = np.zeros(max(program.keys()) + 1 if program else 0, dtype=np.uint32)
+    if program:
+        words[list(program.keys())] = list(program.values())
+
+    return header, MemoryImage(outputs, slices, words, pointers)
+
+
+def read_file(compfile):
+    """
+    Reads a compiled file, text or binary (recognized from its content).
+    :param compfile:
+    :return: tuple (dict, MemoryImage)
+    """
+    with open(compfile, 'rb') as f:
+        magic = f.read(len(seqcompiler.binary_magic))
+
+    if magic == seqcompiler.binary_magic:
+        return seqcompiler.read_binfile(compfile)
+
+    return read_compfile(compfile)
+
+
+def decompile_functions(image, header, channels):
+    """
+    Rebuilds the functions from the outputs and slices blocks.
+    When the number of slices is not known (text files), trailing slices with
+    zero duration and outputs are dropped.
+    :return: tuple of dicts (functions by number, functions_desc by name)
+    """
+    durations = image.slices.reshape((16, 16))
+    outputs = image.outputs.reshape((16, 16))
+    used = (durations != 0) | (outputs != 0)
+    # number of slices: up to the last one in use
+    nslices = np.where(used.any(axis=1), 16 - np.argmax(used[:, ::-1], axis=1), 0)
+
+    functions = {}
+    functions_desc = {}
+    for func_id, name, fullname, nfuncslices in header['functions']:
+        func_id = int(func_id)
+        if func_id == 0:
+            # only the first slice of function #0 is stored
+            nfuncslices = 1
+        elif nfuncslices is None:
+            nfuncslices = max(1, nslices[func_id])
+        func = Function(name=name, fullname=fullname,
+                        timelengths=dict(zip(range(nfuncslices), durations[func_id, :nfuncslices].tolist())),
+                        outputs=dict(zip(range(nfuncslices), outputs[func_id, :nfuncslices].tolist())),
+                        channels=channels)
+        functions[func_id] = func
+        functions_desc[name] = {'idfunc': func_id, 'fullname': fullname, 'function': func}
+
+    return functions, functions_desc
+
+
+def decompile_program(image, header):
+    """
+    Rebuilds the program, with subroutine names on direct JSR instructions.
+    :return: Program
+    """
+    subroutines = header['subroutines']
+    names = {}
+    for name, addr in sorted(subroutines.items(), key=lambda item: item[1]):
+        names.setdefault(addr, name)
+
+    words = image.program
+    used = (words >> 28) != 0
+    jsr_addresses = CompactProgram(words, used).jsr_addresses()
+    direct = np.isin(words >> 28, [Instruction.OP_JumpToSubroutine, Instruction.OP_JumpSubPointerRepeat])
+    jsr_names = {}
+    for addr in np.flatnonzero(used & direct).tolist():
+        target = int(jsr_addresses[addr])
+        if target in names:
+            jsr_names[addr] = names[target]
+
+    return CompactProgram(words, used, subroutines, jsr_names).to_program()
+
+
+def decompile_pointers(image, header, functions, program):
+    """
+    Rebuilds the pointers, with the names of their targets where applicable.
+    :return: dict of SequencerPointer by name
+    """
+    subroutine_names = {}
+    for name, addr in sorted(program.subroutines.items(), key=lambda item: item[1]):
+        subroutine_names.setdefault(addr, name)
+
+    SequencerPointer.init_addresses()
+    pointers = {}
+    for (name, pointer_type), (address, value) in zip(header['pointers'], image.pointers.tolist()):
+        if pointer_type in ['MAIN', 'PTR_SUBR']:
+            target = subroutine_names.get(value, '')
+        elif pointer_type == 'PTR_FUNC' and value in functions:
+            target = functions[value].name
+        else:
+            target = ''
+        ptr = SequencerPointer(pointer_type, name, value=value, target=target)
+        ptr.address = address
+        pointers[name] = ptr
+
+    return pointers
+
+
+def fromcompiledfile(compfile, clockperiod=None):
+    """
+    Create and return a Sequencer instance from a compiled file (text or binary).
+    :param compfile:
+    :param clockperiod: clock period (s), overrides the one stored in the file if any
+    :return: Sequencer
+    """
+    header, image = read_file(compfile)
+
+    if 'channels' in header:
+        chans = dict([(int(c), name) for c, name in header['channels'].items()])
+        channels = bidi.BidiMap(list(chans.keys()), list(chans.values()))
+    else:
+        channels = Sequencer.default_channels
+
+    parameters = dict(header.get('parameters', {}))
+    if clockperiod is not None:
+        parameters['clockperiod'] = clockperiod
+    elif 'clockperiod' not in parameters:
+        parameters['clockperiod'] = default_clockperiod
+
+    functions, functions_desc = decompile_functions(image, header, channels)
+    program = decompile_program(image, header)
+    pointers = decompile_pointers(image, header, functions, program)
+
+    return Sequencer(channels=channels,
+                     functions=functions,
+                     functions_desc=functions_desc,
+                     program=program,
+                     parameters=parameters,
+                     pointers=pointers)
+
+
+Sequencer.fromcompiledfile = staticmethod(fromcompiledfile)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("decompiler.py requires a compiled file")
+        sys.exit()
+    seq = fromcompiledfile(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        seq.timing(sys.argv[2])
+    else:
+        for name in sorted(seq.program.subroutines):
+            print("%s: %.2f us" % (name, seq.timing(name, verbose=False)))
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+
+# Shared loader of channel data (image extensions) from CCD FITS files.
+#
+# Uncompressed files are memory-mapped, and compressed files (.fz) only have the tiles
+# overlapping the region of interest decompressed (through HDU sections, astropy >= 5.3).
+# Channels are read into a single preallocated (channel, line, column) array.
+#
+# Changelog
+# 20261018: initialized, shared by scope, raftstats, jitter and multiscope.
+# 20261018: ChannelReader to read blocks from open files, try_load_channels for file lists.
+#
+# Syntax in a script:
+# import fitsloader
+# data = fitsloader.load_channels("s00-tm-scan.fits")      # all 16 channels, whole segments
+# data = fitsloader.load_channels("s00-tm-scan.fits", ROIrows=slice(100, 1900), ROIcols=slice(530, 576))
+import numpy as np
+from astropy.io import fits
+
+
+def scale_data(raw, header):
+    """
+    Applies the BSCALE/BZERO scaling of the header to raw data, as astropy does
+    (unsigned integers for the usual BZERO offsets, floating point otherwise).
+    Files are opened without scaling, as astropy cannot memory-map scaled data.
+    :param raw: np.array as stored in the file
+    :param header:
+    :return: np.array (native byte order)
+    """
+    raw = raw.astype(raw.dtype.newbyteorder('='), copy=False)
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return raw
+
+    nbits = 8 * raw.dtype.itemsize
+    if bscale == 1 and raw.dtype.kind == 'i' and bzero == 2 ** (nbits - 1):
+        # unsigned integers stored as signed
+        return raw.view(np.dtype('u%d' % raw.dtype.itemsize)) ^ np.array(1 << (nbits - 1)).astype('u%d' % raw.dtype.itemsize)
+
+    if raw.dtype.itemsize <= 2:
+        ftype = np.float32
+    else:
+        ftype = np.float64
+    data = raw.astype(ftype)
+    data *= ftype(bscale)
+    data += ftype(bzero)
+
+    return data
+
+
+def read_hdu(hdu, ROIrows=slice(None), ROIcols=slice(None)):
+    """
+    Reads the region of interest of an image HDU opened without scaling (see load_channels),
+    without reading (or decompressing) the rest when possible.
+    :param hdu: ImageHDU or CompImageHDU
+    :param ROIrows: slice
+    :param ROIcols: slice
+    :return: np.array
+    """
+    raw = None
+    section = getattr(hdu, 'section', None)
+    if section is not None:
+        try:
+            raw = np.asarray(section[ROIrows, ROIcols])
+        except (TypeError, ValueError, IndexError, AttributeError):
+            # unsupported by this HDU or astropy version
+            pass
+    if raw is None:
+        raw = np.asarray(hdu.data[ROIrows, ROIcols])
+
+    return scale_data(raw, hdu.header)
+
+
+class ChannelReader(object):
+    """
+    FITS file kept open to read several regions of its channels, e.g. successive blocks of lines.
+    To be closed after use (or used in a with statement).
+    """
+
+    def __init__(self, fitsfile):
+        self.fitsfile = fitsfile
+        self.hdulist = fits.open(fitsfile, memmap=True, do_not_scale_image_data=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.hdulist is not None:
+            self.hdulist.close()
+            self.hdulist = None
+
+    def header(self, channel=0):
+        return self.hdulist[channel + 1].header
+
+    def shape(self, channel=0):
+        """
+        (lines, columns) of the image of a channel.
+        """
+        h = self.header(channel)
+        return h['NAXIS2'], h['NAXIS1']
+
+    def tile_rows(self, channel=0):
+        """
+        Number of lines of the compression tiles of a channel (1 if not compressed).
+        """
+        hdu = self.hdulist[channel + 1]
+        if not isinstance(hdu, fits.CompImageHDU):
+            return 1
+        tile_shape = getattr(hdu, 'tile_shape', None)
+        if tile_shape is None:
+            # older astropy
+            return hdu._header.get('ZTILE2', 1)
+        return int(tile_shape[0])
+
+    def read(self, channels=range(16), ROIrows=slice(None), ROIcols=slice(None), out=None, dtype=None,
+             headers=False):
+        """
+        Same as load_channels(), on the open file.
+        """
+        channels = list(channels)
+        hdrs = []
+        for k, c in enumerate(channels):
+            hdu = self.hdulist[c + 1]
+            block = read_hdu(hdu, ROIrows, ROIcols)
+            if out is None:
+                out = np.empty((len(channels),) + block.shape, dtype=dtype or block.dtype)
+            out[k] = block
+            if headers:
+                hdrs.append(hdu.header)
+
+        if headers:
+            return out, hdrs
+
+        return out
+
+
+def row_blocks(ROIrows, nlines, rowblock, tilerows=1):
+    """
+    Splits a range of lines into blocks of about rowblock lines. Block boundaries fall on
+    multiples of tilerows, so that each compression tile is decompressed in a single block.
+    :param ROIrows: slice (normalized against nlines)
+    :param nlines: number of lines of the image
+    :param rowblock: number of lines per block (rounded up to a multiple of tilerows)
+    :param tilerows: number of lines of the compression tiles
+    :return: list of slices
+    """
+    start, stop, step = ROIrows.indices(nlines)
+    if step != 1:
+        raise ValueError('Blocks of lines need contiguous lines: %s' % ROIrows)
+    rowblock = -(-rowblock // tilerows) * tilerows
+
+    blocks = []
+    while start < stop:
+        end = min((start // rowblock + 1) * rowblock, stop)
+        blocks.append(slice(start, end))
+        start = end
+
+    return blocks
+
+
+def load_channels(fitsfile, channels=range(16), ROIrows=slice(None), ROIcols=slice(None),
+                  out=None, dtype=None, headers=False):
+    """
+    Reads the region of interest of the given channels of a FITS file (channel c in extension c+1).
+    :param fitsfile:
+    :param channels: channels (numbered from 0)
+    :param ROIrows: slice
+    :param ROIcols: slice
+    :param out: array of shape (nchannels, rows, columns) to fill in, allocated if None
+    :param dtype: type of the allocated array, type of the file data if None
+    :param headers: if True, also returns the list of extension headers
+    :return: np.array of shape (nchannels, rows, columns), or tuple (array, headers)
+    """
+    with ChannelReader(fitsfile) as reader:
+        return reader.read(channels, ROIrows, ROIcols, out, dtype, headers)
+
+
+# errors of unreadable, missing or malformed files
+read_errors = (IOError, OSError, ValueError, IndexError, KeyError)
+
+
+def try_load_channels(fitsfile, channels=range(16), ROIrows=slice(None), ROIcols=slice(None),
+                      out=None, dtype=None):
+    """
+    Same as load_channels(), for reading many files: a file that cannot be read is reported
+    and None is returned instead of raising.
+    """
+    try:
+        return load_channels(fitsfile, channels, ROIrows, ROIcols, out, dtype)
+    except read_errors as e:
+        print("Failed to read %s: %s" % (fitsfile, e))
+        return None
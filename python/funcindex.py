@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+#
+# LSST
+# Content-addressed index of the sequencer functions of a tree of sequencer files.
+#
+# Each function is hashed by its waveform (time slices durations and outputs), independently
+# of its name: the index maps each hash to the (file, function name) pairs using it, so that
+# finding all sequencer files sharing a waveform is a lookup instead of a re-parse.
+#
+# Changelog
+# 20261018: initialized.
+#
+# Syntax as main:
+# python funcindex.py [-c] -o [index file] [dir|glob] <[dir|glob] ...>
+# python funcindex.py -i [index file] [sequencer-file.seq] [function name]
+# Example:
+# python funcindex.py -o funcindex.json ..
+# python funcindex.py -i funcindex.json ../run5/seq.seq ReadPixel
+#
+# Syntax in a script:
+# import funcindex
+# index = funcindex.build_index([".."])
+# funcindex.find_function(index, "../run5/seq.seq", "ReadPixel")
+from __future__ import print_function
+import sys
+import hashlib
+import json
+import optparse
+
+import rebtxt
+import grammar
+import seqcompiler
+
+
+def function_hash(func):
+    """
+    Hash of the waveform of a function: durations and outputs of all its time slices.
+    :param func: Function
+    :return: hex string
+    """
+    tslices = sorted(set(func.timelengths) | set(func.outputs))
+    content = ';'.join(['%d:%d:%d' % (t, func.timelengths.get(t, 0), func.outputs.get(t, 0)) for t in tslices])
+
+    return hashlib.sha1(content.encode('ascii')).hexdigest()[:16]
+
+
+def index_task(task):
+    """
+    Hashes all functions of a single file for build_index() (runs in a worker process).
+    Returns (source, list of (hash, function name, total time), error message).
+    """
+    seqfile, cachedir = task
+
+    try:
+        seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False, cachedir=cachedir)
+        entries = [(function_hash(func), func.name, func.total_time())
+                   for func_id, func in sorted(seq.functions.items())]
+        error = ''
+    except Exception as e:
+        entries = []
+        error = '%s: %s' % (type(e).__name__, e)
+
+    return seqfile, entries, error
+
+
+def build_index(patterns, nprocs=None, cachedir=None):
+    """
+    Parses all sequencer files given as directories or glob patterns (in a pool of processes)
+    and indexes their functions.
+    Index content:
+    'files': list of indexed files,
+    'functions': hash -> list of [file number, function name],
+    'durations': hash -> total time of the function (clock cycles),
+    'errors': file -> error message for the files that could not be parsed.
+    :param patterns: list of directories or glob patterns
+    :param nprocs: number of processes (default: number of CPUs)
+    :param cachedir: parse cache directory (see grammar.parse_file_cached)
+    :return: dict
+    """
+    seqfiles = seqcompiler.find_seqfiles(patterns)
+    results = seqcompiler.batch_map(index_task, [(seqfile, cachedir) for seqfile in seqfiles], nprocs)
+
+    index = {'files': [], 'functions': {}, 'durations': {}, 'errors': {}}
+    for seqfile, entries, error in results:
+        if error:
+            index['errors'][seqfile] = error
+            continue
+        ifile = len(index['files'])
+        index['files'].append(seqfile)
+        for h, name, duration in entries:
+            index['functions'].setdefault(h, []).append([ifile, name])
+            index['durations'][h] = duration
+
+    return index
+
+
+def save_index(index, filename):
+    with open(filename, 'w') as f:
+        json.dump(index, f, separators=(',', ':'), sort_keys=True)
+
+
+def load_index(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def find_hash(index, h):
+    """
+    All uses of the waveform with the given hash.
+    :param index:
+    :param h: function hash
+    :return: list of (file, function name)
+    """
+    return [(index['files'][ifile], name) for ifile, name in index['functions'].get(h, [])]
+
+
+def lookup(index, func):
+    """
+    All uses of the waveform of the given function.
+    :param index:
+    :param func: Function
+    :return: list of (file, function name)
+    """
+    return find_hash(index, function_hash(func))
+
+
+def find_function(index, seqfile, funcname):
+    """
+    All uses of the waveform of the function of given name in the given indexed file.
+    :param index:
+    :param seqfile: file name, as in the index
+    :param funcname:
+    :return: list of (file, function name)
+    """
+    if seqfile not in index['files']:
+        raise ValueError('File not in index: %s' % seqfile)
+    ifile = index['files'].index(seqfile)
+
+    for h, uses in index['functions'].items():
+        if [ifile, funcname] in uses:
+            return find_hash(index, h)
+
+    raise ValueError('Function %s not found in %s' % (funcname, seqfile))
+
+
+def print_summary(index, nshared=10):
+    """
+    Prints size of index and the most shared waveforms.
+    """
+    print("Indexed %d files (%d failed), %d distinct functions" %
+          (len(index['files']), len(index['errors']), len(index['functions'])))
+
+    shared = sorted(index['functions'].items(), key=lambda item: len(item[1]), reverse=True)
+    for h, uses in shared[:nshared]:
+        names = sorted(set([name for ifile, name in uses]))
+        print("%s  %5d files  %8d cycles  %s" % (h, len(set([ifile for ifile, name in uses])),
+                                                  index['durations'][h], ', '.join(names)))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = \
+    """
+    %prog -o <index-file> [-j <nprocs>] [-c] <dir|glob> [<dir|glob> ...]
+    %prog -i <index-file> <sequencer-file> <function-name>
+
+    Builds an index of the functions of all sequencer files, by waveform,
+    or looks up all files and functions sharing the waveform of a function.
+    """)
+    parser.add_option('-o', '--output', default='',
+                      help='Builds index and writes it to the given file')
+    parser.add_option('-i', '--index', default='',
+                      help='Looks up function in the given index file')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Number of processes (default: number of CPUs)')
+    parser.add_option('-c', '--cache', default=False, action='store_true',
+                      help='Reuse parse results cached in %s' % grammar.default_cachedir)
+
+    (options, args) = parser.parse_args()
+
+    if options.cache:
+        cachedir = grammar.default_cachedir
+    else:
+        cachedir = None
+
+    if options.output and args:
+        index = build_index(args, nprocs=options.jobs, cachedir=cachedir)
+        save_index(index, options.output)
+        print_summary(index)
+    elif options.index and len(args) == 2:
+        index = load_index(options.index)
+        for seqfile, name in find_function(index, args[0], args[1]):
+            print("%s  %s" % (seqfile, name))
+    else:
+        parser.print_help()
+        sys.exit(1)
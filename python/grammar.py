@@ -4,7 +4,11 @@
 #
 # Author: Laurent Le Guillou
 from __future__ import print_function
+import sys
+import os
 import re
+import pickle
+import hashlib
 
 class SeqParser(object):
 
@@ -46,15 +50,16 @@ class SeqParser(object):
         self.verbose = verbose
         
         # compiling patterns
-        self.p_zmsp =    re.compile("^" + self._p_zmsp)
-        self.p_omsp =    re.compile("^" + self._p_omsp)
-        self.p_newline = re.compile("^" + self._p_newline)
-        self.p_comment = re.compile("^" + self._p_comment)
-        self.p_integer = re.compile("^" + self._p_integer)
-        self.p_address = re.compile("^" + self._p_address)
-        self.p_name =    re.compile("^" + self._p_name)
-        self.p_duration_unit = re.compile("^" + self._p_duration_unit)
-        self.p_file = re.compile("^" + self._p_file)
+        # (applied in place with pattern.match(s, pos): the input string is never sliced)
+        self.p_zmsp =    re.compile(self._p_zmsp)
+        self.p_omsp =    re.compile(self._p_omsp)
+        self.p_newline = re.compile(self._p_newline)
+        self.p_comment = re.compile(self._p_comment)
+        self.p_integer = re.compile(self._p_integer)
+        self.p_address = re.compile(self._p_address)
+        self.p_name =    re.compile(self._p_name)
+        self.p_duration_unit = re.compile(self._p_duration_unit)
+        self.p_file = re.compile(self._p_file)
 
     #=======================================================================
 
@@ -67,12 +72,11 @@ class SeqParser(object):
             return pos
 
         # Always match, eat spaces
-        matches = self.p_zmsp.search(self.s[pos:])
+        matches = self.p_zmsp.match(self.s, pos)
         if matches is None:
             return pos
 
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
         return pnext
 
 
@@ -81,12 +85,11 @@ class SeqParser(object):
         if pos >= self.length:
             return None
         
-        matches = self.p_omsp.search(self.s[pos:])
+        matches = self.p_omsp.match(self.s, pos)
         if matches == None:
             return None
 
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
         return pnext
     
     #-----------------------------------------------------------------------
@@ -96,13 +99,12 @@ class SeqParser(object):
         if pos >= self.length:
             return None
 
-        matches = self.p_newline.search(self.s[pos:])
+        matches = self.p_newline.match(self.s, pos)
         if matches == None:
             return None
 
         # start = matches.start()
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
 
         return pnext
 
@@ -113,14 +115,13 @@ class SeqParser(object):
         if pos >= self.length:
             return None
 
-        matches = self.p_comment.search(self.s[pos:])
+        matches = self.p_comment.match(self.s, pos)
         if matches == None:
             return None
 
         # start = matches.start()
-        l = matches.end()
         comment = matches.group(1)
-        pnext = pos + l
+        pnext = matches.end()
 
         comment = comment.strip()
         
@@ -163,13 +164,12 @@ class SeqParser(object):
     def m_integer(self, pos):
         pnext = pos
 
-        matches = self.p_integer.search(self.s[pnext:])
+        matches = self.p_integer.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         integer = int(matches.group(1))
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, integer)
 
@@ -179,13 +179,12 @@ class SeqParser(object):
     def m_address(self, pos):
         pnext = pos
 
-        matches = self.p_integer.search(self.s[pnext:])
+        matches = self.p_integer.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         address = int(matches.group(1), 16)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, address)
 
@@ -195,13 +194,12 @@ class SeqParser(object):
     def m_name(self, pos):
         pnext = pos
 
-        matches = self.p_name.search(self.s[pnext:])
+        matches = self.p_name.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         name = matches.group(1)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, name)
 
@@ -216,7 +214,7 @@ class SeqParser(object):
         s_section_marker = self._p_section_marker % section_name
         l = len(s_section_marker)
         
-        if ( self.s[pnext:pnext+l] != s_section_marker ):
+        if not self.s.startswith(s_section_marker, pnext):
             return None
 
         pnext = pnext + l
@@ -243,13 +241,12 @@ class SeqParser(object):
     def m_duration_unit(self, pos):
         pnext = pos
 
-        matches = self.p_duration_unit.search(self.s[pos:])
+        matches = self.p_duration_unit.match(self.s, pos)
         if matches == None:
             return None
 
-        l = matches.end()
         unit = matches.group(1)
-        pnext = pos + l
+        pnext = matches.end()
 
         return pnext, unit
 
@@ -281,13 +278,12 @@ class SeqParser(object):
     def m_file_name(self,pos):
         pnext = pos
 
-        matches = self.p_file.search(self.s[pnext:])
+        matches = self.p_file.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         name = matches.group(1)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, name)
 
@@ -563,7 +559,7 @@ class SeqParser(object):
 
         l = len(self._s_rep_func_def_keyword)
         
-        if ( self.s[pnext:pnext+l] != self._s_rep_func_def_keyword ):
+        if not self.s.startswith(self._s_rep_func_def_keyword, pnext):
             return None
         pnext = pnext + l
 
@@ -615,7 +611,7 @@ class SeqParser(object):
 
         l = len(self._s_rep_subr_def_keyword)
         
-        if ( self.s[pnext:pnext+l] != self._s_rep_subr_def_keyword ):
+        if not self.s.startswith(self._s_rep_subr_def_keyword, pnext):
             return None
         pnext = pnext + l
 
@@ -666,7 +662,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_ptr_func_def_keyword)
-        if ( self.s[pnext:pnext+l] != self._s_ptr_func_def_keyword ):
+        if not self.s.startswith(self._s_ptr_func_def_keyword, pnext):
             return None
         pnext = pnext + l
 
@@ -722,7 +718,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_ptr_subr_def_keyword)
-        if ( self.s[pnext:pnext+l] != self._s_ptr_subr_def_keyword ):
+        if not self.s.startswith(self._s_ptr_subr_def_keyword, pnext):
             return None
         pnext = pnext + l
 
@@ -777,7 +773,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_main_def_keyword)
-        if ( self.s[pnext:pnext+l] != self._s_main_def_keyword ):
+        if not self.s.startswith(self._s_main_def_keyword, pnext):
             return None
         pnext = pnext + l
 
@@ -994,7 +990,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_func_clocks_marker)
-        if self.s[pnext:pnext+l] != self._s_func_clocks_marker:
+        if not self.s.startswith(self._s_func_clocks_marker, pnext):
             return None
         pnext += l
 
@@ -1073,7 +1069,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_func_slices_marker)
-        if self.s[pnext:pnext+l] != self._s_func_slices_marker:
+        if not self.s.startswith(self._s_func_slices_marker, pnext):
             return None
         pnext += l
 
@@ -1217,7 +1213,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
 
         l = len(self._s_func_constants_marker)
-        if self.s[pnext:pnext+l] != self._s_func_constants_marker:
+        if not self.s.startswith(self._s_func_constants_marker, pnext):
             return None
         pnext += l
 
@@ -1482,7 +1478,7 @@ class SeqParser(object):
         pnext = pos
 
         l = len(self._s_inf)
-        if self.s[pnext:pnext+l] == self._s_inf:
+        if self.s.startswith(self._s_inf, pnext):
             pnext += l
             return pnext, ("INFINITY", "Inf")
 
@@ -1523,7 +1519,7 @@ class SeqParser(object):
         pnext = pos
 
         l = len(self._s_repeat_start)
-        if self.s[pnext:pnext+l] != self._s_repeat_start:
+        if not self.s.startswith(self._s_repeat_start, pnext):
             return None
         pnext += l
 
@@ -1559,7 +1555,7 @@ class SeqParser(object):
         # print [1], pnext
         
         l = len(self._s_instr_call_opname)
-        if self.s[pnext:pnext+l] != self._s_instr_call_opname:
+        if not self.s.startswith(self._s_instr_call_opname, pnext):
             return None
         pnext += l
         # print [2], pnext
@@ -1728,7 +1724,7 @@ class SeqParser(object):
         pnext = pos
 
         l = len(self._s_repeat_start)
-        if self.s[pnext:pnext+l] != self._s_repeat_start:
+        if not self.s.startswith(self._s_repeat_start, pnext):
             return None
         pnext += l
 
@@ -1764,7 +1760,7 @@ class SeqParser(object):
         #print [1], pnext
         
         l = len(self._s_instr_jsr_opname)
-        if self.s[pnext:pnext+l] != self._s_instr_jsr_opname:
+        if not self.s.startswith(self._s_instr_jsr_opname, pnext):
             return None
         pnext += l
         #print [2], pnext
@@ -1822,7 +1818,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
         
         l = len(self._s_instr_rts_opname)
-        if self.s[pnext:pnext+l] != self._s_instr_rts_opname:
+        if not self.s.startswith(self._s_instr_rts_opname, pnext):
             return None
         pnext += l
 
@@ -1854,7 +1850,7 @@ class SeqParser(object):
         pnext = self.m_zmsp(pnext)
         
         l = len(self._s_instr_end_opname)
-        if self.s[pnext:pnext+l] != self._s_instr_end_opname:
+        if not self.s.startswith(self._s_instr_end_opname, pnext):
             return None
         pnext += l
 
@@ -2146,29 +2142,148 @@ def merge_result(stronger, weaker):
     merge_section_dicts(stronger['mains'], weaker['mains'], 'name')
 
 
-def parse_file(txtfile, verbose=True):
+# pickled parsed content of each file (includes not merged), keyed by (absolute path, content hash)
+# (stored pickled: every hit gets its own copy, as the include merge modifies the result)
+_include_cache = {}
+
+
+def clear_include_cache():
+    """
+    Empties the cache of parsed files shared by all calls to parse_file().
+    :return:
+    """
+    _include_cache.clear()
+
+
+def file_digest(s):
+    """
+    Content hash of a sequencer file, used to detect changes in cached files.
+    :param s: file content
+    :return: hex string
+    """
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def parse_file(txtfile, verbose=True, including=(), depends=None):
     """
     Parses input file, manages 'includes' section.
+    Each file is parsed only once per process: the parsed content is cached under its
+    absolute path and content hash, so that a file included by many others is not re-parsed.
     :param txtfile:
+    :param verbose:
+    :param including: absolute paths of the files currently including this one (cycle detection)
+    :param depends: if given, list extended with (absolute path, content hash) of all files read
     :return:
     """
+    abspath = os.path.abspath(txtfile)
+    if abspath in including:
+        raise ValueError('Include cycle: %s' % ' -> '.join(list(including) + [abspath]))
+
     sfile = open(txtfile, 'r')
     s = sfile.read()
     sfile.close()
 
-    seq = SeqParser(s, verbose)
-    result = seq.m_seq(0)
+    key = (abspath, file_digest(s))
+    if depends is not None:
+        depends.append(key)
+
+    if key in _include_cache:
+        result = pickle.loads(_include_cache[key])
+    else:
+        seq = SeqParser(s, verbose)
+        result = seq.m_seq(0)
+        if result is not None:
+            _include_cache[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
 
     # child values overwrite parents in case of conflict, with inheritance order from [includes]
-    # manages recursivity (even though it is a terribly dangerous idea)
+    # manages recursivity (cycles are detected and rejected)
 
     # includes section is a list of tuples (file, comment)
     for parentfile in reversed(result['includes']):
         parentname = parentfile[0]
-        print('Including sequencer file: %s ' % parentname)
-        parentresult = parse_file(parentname, verbose)
+        if verbose:
+            print('Including sequencer file: %s ' % parentname)
+        parentresult = parse_file(parentname, verbose, including=tuple(including) + (abspath,),
+                                  depends=depends)
         merge_result(result, parentresult)
 
     return result
 
 
+# on-disk cache for parse results, used by parse_file_cached() (disabled if empty)
+parse_cachedir = os.environ.get('SEQ_CACHE_DIR', '')
+
+default_cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'sequencer-files')
+
+
+def parse_file_cached(txtfile, verbose=True, cachedir=None):
+    """
+    Same as parse_file(), going through an on-disk cache of parse results.
+    An entry is keyed by the content of the file, and is valid as long as the file
+    and all the files it includes keep the same content.
+    The cache directory is taken from the module 'parse_cachedir' variable (initialized
+    from the SEQ_CACHE_DIR environment variable) if not given. No caching if empty.
+    :param txtfile:
+    :param verbose:
+    :param cachedir: directory for the cache files
+    :return:
+    """
+    if cachedir is None:
+        cachedir = parse_cachedir
+    if not cachedir:
+        return parse_file(txtfile, verbose)
+
+    abspath = os.path.abspath(txtfile)
+    sfile = open(txtfile, 'r')
+    s = sfile.read()
+    sfile.close()
+
+    # included files are looked up from the current directory
+    entryname = file_digest('\n'.join([abspath, os.getcwd(), file_digest(s)])) + '.pickle'
+    entryfile = os.path.join(cachedir, entryname)
+
+    if os.path.exists(entryfile):
+        try:
+            with open(entryfile, 'rb') as f:
+                entry = pickle.load(f)
+            if check_depends(entry['depends']):
+                return entry['result']
+        except Exception as e:
+            print('Ignoring unreadable parse cache entry %s: %s' % (entryfile, e), file=sys.stderr)
+
+    depends = []
+    result = parse_file(txtfile, verbose, depends=depends)
+
+    if result is not None:
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # created meanwhile by another process
+                pass
+        # write then rename, so that concurrent readers never see a partial entry
+        tmpfile = '%s.%d.tmp' % (entryfile, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            pickle.dump({'depends': depends, 'result': result}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, entryfile)
+
+    return result
+
+
+def check_depends(depends):
+    """
+    Checks that all files recorded as (absolute path, content hash) are unchanged.
+    :param depends:
+    :return: bool
+    """
+    for path, digest in depends:
+        try:
+            sfile = open(path, 'r')
+            s = sfile.read()
+            sfile.close()
+        except IOError:
+            return False
+        if file_digest(s) != digest:
+            return False
+
+    return True
@@ -15,23 +15,12 @@ def get_scan_data(hfile, datadir, ROI=slice(1, 1000)):
     """
     fitsfile = os.path.join(datadir, hfile)
     try:
-        h = pyfits.open(fitsfile)
+        stats = raftstats.file_stats(fitsfile, [(ROI, slice(None))], axis=0, median=False)[0]
     except:
         print("Failed to open %s" % fitsfile)
         return [], []
 
-    imax = h[1].data.shape[1]
-    linedata = np.zeros((16, imax))
-    linestd = np.zeros((16, imax))
-
-    for channel in range(16):
-        linedata[channel, :] = h[channel + 1].data[ROI, :].mean(axis=0)
-        linestd[channel, :] = h[channel + 1].data[ROI, :].std(axis=0)
-
-    h.close()
-    del h
-
-    return linedata, linestd
+    return stats['mean'], stats['std']
 
 
 def get_raft_jitter(listfile, listsensor, datadir, RObaseline, ROjump):
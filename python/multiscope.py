@@ -4,6 +4,7 @@
 #
 # Changelog
 # 20161207: C. Juramy, initialized from LPNHE bench code.
+# 20261018: raft FITS files read in parallel (load_raft)
 #
 # Syntax as main:
 # python multiscope.py [s00-tm-scan.fits]
@@ -16,13 +17,62 @@
 from __future__ import print_function
 import sys
 import os.path
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as mplcol
 import scope
+import fitsloader
 from astropy.io import fits
 
 
+def load_raft(fitsfiles, selectchannels=range(16), ROIrows=slice(None), ROIcols=slice(None), nthreads=None):
+    """
+    Reads the FITS files of all CCDs of a raft in parallel (threads: decompression and I/O
+    run outside of the interpreter lock), into a single preallocated array.
+    Slots with a missing or unreadable file are left at zero and flagged.
+    :param fitsfiles: list of files, one per CCD (empty name for a missing slot)
+    :param selectchannels: channels to read
+    :param ROIrows: slice
+    :param ROIcols: slice
+    :param nthreads: number of threads (default: one per file)
+    :return: np.array of shape (ccd, channel, line, column), list of booleans (slot read)
+    """
+    channels = list(selectchannels)
+    present = [bool(f) and os.path.isfile(f) for f in fitsfiles]
+    if not any(present):
+        raise ValueError('No file found for raft: %s' % ', '.join(fitsfiles))
+
+    # shape and type of the data from a single channel
+    sample = fitsloader.load_channels(fitsfiles[present.index(True)], channels[:1], ROIrows, ROIcols)
+    raftdata = np.zeros((len(fitsfiles), len(channels)) + sample.shape[1:], dtype=sample.dtype)
+
+    def load_slot(num):
+        if not present[num]:
+            print("Missing file for slot %d: %s" % (num, fitsfiles[num]))
+            return False
+        return fitsloader.try_load_channels(fitsfiles[num], channels, ROIrows, ROIcols, out=raftdata[num]) is not None
+
+    pool = ThreadPool(nthreads or len(fitsfiles))
+    try:
+        loaded = pool.map(load_slot, range(len(fitsfiles)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return raftdata, loaded
+
+
+def get_loaded_slots(fitsfiles, seglist):
+    """
+    Reads raft files with load_raft(), returns list of data arrays and segment names for the slots read.
+    """
+    raftdata, loaded = load_raft(fitsfiles)
+
+    return [raftdata[num] for num in range(len(fitsfiles)) if loaded[num]], \
+           [seg for num, seg in enumerate(seglist) if loaded[num]]
+
+
 def get_scandata_raft(inputfile, datadir=''):
     """
     Builds up list of data arrays from all raft files (one array per CCD), plus list of segment names.
@@ -46,8 +96,7 @@ def get_scandata_raft(inputfile, datadir=''):
             raftfits = [inputfile.replace("S00", 'S' + s, 1) for s in seglist]
         else:
             raftfits = [inputfile.replace("00-", s + '-', 1) for s in seglist]
-        for f in raftfits:
-            raftarrays.append(scope.get_scandata_fromfile(f, datadir))
+        raftarrays, seglist = get_loaded_slots([os.path.join(datadir, f) for f in raftfits], seglist)
     elif os.path.splitext(inputfile)[1] == ".dat":
         # starts with Reb0 through Reb2
         reblist = ["Reb0", "Reb1", "Reb2"]
@@ -59,14 +108,19 @@ def get_scandata_raft(inputfile, datadir=''):
             raftarrays.extend([a for a in np.split(fullreb, 3, axis=0)])  # splits REB data into 3 CCDs
     elif inputfile == '':
         seglist = slot_ids()
+        raftfits = []
         for segstr in seglist:
             d = os.path.join(datadir, 'S%s' % segstr)
-            for f in os.listdir(d):
-                #print f
-                if os.path.splitext(f)[1] in [".fits", ".fz"]  and os.stat(os.path.join(d, f)).st_size > 1e6:
-                    # one file per directory
-                    raftarrays.append(scope.get_scandata_fromfile(f, d))
-                    break
+            slotfile = ''
+            if os.path.isdir(d):
+                for f in os.listdir(d):
+                    #print f
+                    if os.path.splitext(f)[1] in [".fits", ".fz"]  and os.stat(os.path.join(d, f)).st_size > 1e6:
+                        # one file per directory
+                        slotfile = os.path.join(d, f)
+                        break
+            raftfits.append(slotfile)
+        raftarrays, seglist = get_loaded_slots(raftfits, seglist)
     else:
         seglist = []
 
@@ -80,13 +134,9 @@ def get_scandata_bot(raft, datadir):
             lf.append(f)
     lf = sorted(lf)
     
-    seglist = []
-    raftarrays = []
-    for f in lf:
-        ccd = f.split('-')[2]
-        raftarrays.append(scope.get_scandata_fromfile(f, datadir))
-        seglist.append(ccd)
-        
+    seglist = [f.split('-')[2] for f in lf]
+    raftarrays, seglist = get_loaded_slots([os.path.join(datadir, f) for f in lf], seglist)
+
     return raftarrays, seglist
 
 
@@ -292,38 +342,89 @@ def reframe_scope_frames(listfits):
         hcopy.writeto(f[:-5] + "f.fz", clobber=True)
 
 
-def corrcoef_raftscope(raftsfits, ROIrows, ROIcols, norm=True):
+def accumulate_scope_correlation(acc, block, norm=True):
+    """
+    Adds to acc the sum over columns of the correlation (or covariance) matrices between
+    channels, computed along lines for each column of the block.
+    :param acc: np.array (nchannels, nchannels), float
+    :param block: np.array (nchannels, lines, columns)
+    :param norm: if True, correlation coefficients, if not, covariances
+    :return:
+    """
+    x = block.astype(np.float64)
+    x -= x.mean(axis=1, keepdims=True)
+    if norm:
+        x /= np.sqrt((x ** 2).sum(axis=1, keepdims=True))
+        acc += np.tensordot(x, x, axes=([1, 2], [1, 2]))
+    else:
+        acc += np.tensordot(x, x, axes=([1, 2], [1, 2])) / (x.shape[1] - 1)
+
+
+def corrcoef_raftscope(raftsfits, ROIrows, ROIcols, norm=True, streaming=False, colblock=16, rowblock=128):
     """
     Correlation over one or more CCDs, calculating correlation along lines at each time index in ROIcols,
     then averaging.
+    Correlations of all columns are computed together (by blocks of columns) and summed in place.
+    In streaming mode, files are kept open and read by blocks of lines (aligned on the compression
+    tiles, so that each tile is decompressed once), and sums and cross-products are accumulated
+    for each column: memory is (channels x channels x columns) instead of the data of all channels.
     :param raftsfits: file list
     :param ROIrows: must be in the format: slice(start, stop)
     :param ROIcols: must be in the format: slice(start, stop)
     :param norm: if True, computes correlation coefficients; if not, returns covariances
+    :param streaming: if True, reads files by blocks of lines
+    :param colblock: number of columns per block (not streaming)
+    :param rowblock: number of lines per block (streaming)
     :return:
     """
-    stackh = []
-
-    for fl in raftsfits:
-        h = fits.open(fl)
-        for i in range(1, 17):
-            stackh.append(h[i].data[ROIrows, ROIcols])
-        h.close()
-        del h
-    stackh = np.stack(stackh)
-    print(stackh.shape)
-
-    a = []
-
-    for numcol in range(ROIcols.stop - ROIcols.start):
+    nchannels = 16 * len(raftsfits)
+    ncols = ROIcols.stop - ROIcols.start
+
+    if streaming:
+        nrows = 0
+        shift = None
+        sums = np.zeros((ncols, nchannels))
+        products = np.zeros((ncols, nchannels, nchannels))
+        readers = []
+        try:
+            for fl in raftsfits:
+                readers.append(fitsloader.ChannelReader(fl))
+            blocks = fitsloader.row_blocks(ROIrows, readers[0].shape()[0], rowblock, readers[0].tile_rows())
+            for blockrows in blocks:
+                block = np.empty((nchannels, blockrows.stop - blockrows.start, ncols))
+                for num, reader in enumerate(readers):
+                    reader.read(range(16), blockrows, ROIcols, out=block[num * 16:(num + 1) * 16])
+                # (column, channel, line), shifted by the first block average for precision
+                x = block.transpose((2, 0, 1))
+                if shift is None:
+                    shift = x.mean(axis=2, keepdims=True)
+                x -= shift
+                nrows += x.shape[2]
+                sums += x.sum(axis=2)
+                products += np.matmul(x, x.transpose((0, 2, 1)))
+        finally:
+            for reader in readers:
+                reader.close()
+
+        cov = (products - sums[:, :, np.newaxis] * sums[:, np.newaxis, :] / nrows) / (nrows - 1)
         if norm:
-            a.append(np.corrcoef(stackh[:, :, numcol]))
-        else:
-            a.append(np.cov(stackh[:, :, numcol]))
-    a = np.stack(a)
-    print(a.shape)
-
-    return a.mean(axis=0)
+            stddev = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+            cov /= stddev[:, :, np.newaxis]
+            cov /= stddev[:, np.newaxis, :]
+        acc = cov.sum(axis=0)
+    else:
+        acc = np.zeros((nchannels, nchannels))
+        stackh = []
+        for fl in raftsfits:
+            stackh.append(fitsloader.load_channels(fl, range(16), ROIrows, ROIcols))
+        stackh = np.concatenate(stackh)
+        print(stackh.shape)
+        for start in range(0, ncols, colblock):
+            accumulate_scope_correlation(acc, stackh[:, :, start:start + colblock], norm)
+
+    acc /= ncols
+
+    return acc
 
 
 def plot_corrcoef_raftscope(raftsfits, ROIrows, ROIcols, xylabels=None, title='', norm=True):
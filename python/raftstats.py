@@ -5,10 +5,13 @@
 
 import os
 import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import astropy.io.fits as pyfits
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as mplcol
+import fitsloader
 
 def get_fits_raft(inputfile='', datadir=''):
     """
@@ -43,6 +46,140 @@ def get_fits_raft(inputfile='', datadir=''):
     return raftfits, seglist
 
 
+def stats_names(percentiles=(), median=True):
+    """
+    Names of the statistics computed by channel_stats(), percentile q being 'p<q>' (with '_' for '.').
+    """
+    names = ['mean', 'std']
+    if median:
+        names.append('median')
+    names += [('p%g' % q).replace('.', '_') for q in percentiles]
+
+    return names
+
+
+def channel_stats(data, axis=None, percentiles=(), median=True):
+    """
+    Statistics of all channels at once, from stacked channel data.
+    :param data: np.array (channel, line, column)
+    :param axis: None for statistics over the whole region,
+    0 over lines (one value per column), 1 over columns (one value per line)
+    :param percentiles: list of percentiles to compute (0-100)
+    :param median: if False, skips the median (and the sort it requires when no percentile is asked)
+    :return: np.recarray of shape (channel,) or (channel, columns or lines), fields from stats_names()
+    (accessed as stats['mean'], as stats.mean is the method of np.ndarray)
+    """
+    if axis is None:
+        axes = (1, 2)
+    else:
+        axes = axis + 1
+
+    values = [data.mean(axis=axes, dtype=np.float64), data.std(axis=axes, dtype=np.float64)]
+    quantiles = list(percentiles)
+    if median:
+        quantiles.insert(0, 50)
+    if quantiles:
+        values += list(np.percentile(data, quantiles, axis=axes))
+
+    return np.rec.fromarrays(values, names=stats_names(percentiles, median))
+
+
+def bounding_slice(slices):
+    """
+    Smallest slice containing all given slices (non-negative bounds, no step).
+    """
+    starts = [s.start for s in slices]
+    stops = [s.stop for s in slices]
+    start = None if None in starts else min(starts)
+    stop = None if None in stops else max(stops)
+
+    return slice(start, stop)
+
+
+def relative_slice(s, box):
+    """
+    Slice s relative to the start of the bounding slice box.
+    """
+    offset = box.start or 0
+    return slice(None if s.start is None else s.start - offset, None if s.stop is None else s.stop - offset)
+
+
+def bounding_roi(rois):
+    """
+    Smallest (ROIrows, ROIcols) containing all given regions of interest.
+    """
+    return bounding_slice([r[0] for r in rois]), bounding_slice([r[1] for r in rois])
+
+
+def rois_stats(data, rois, axis=None, percentiles=(), median=True):
+    """
+    Statistics of several regions of interest, from the data of their bounding region (see bounding_roi()).
+    :param data: np.array (channel, line, column) of the bounding region
+    :return: list of np.recarray (one per ROI, see channel_stats())
+    """
+    boxrows, boxcols = bounding_roi(rois)
+
+    return [channel_stats(data[:, relative_slice(rows, boxrows), relative_slice(cols, boxcols)],
+                          axis, percentiles, median) for rows, cols in rois]
+
+
+def file_stats(fitsfile, rois, channels=range(16), axis=None, percentiles=(), median=True, headers=False):
+    """
+    Statistics of several regions of interest of all channels of a FITS file,
+    from a single read of the region containing all of them.
+    :param fitsfile:
+    :param rois: list of (ROIrows, ROIcols) slices
+    :param channels:
+    :param axis: see channel_stats()
+    :param percentiles: see channel_stats()
+    :param median: see channel_stats()
+    :param headers: if True, also returns the list of extension headers
+    :return: list of np.recarray (one per ROI, see channel_stats()), or tuple (list, headers)
+    """
+    boxrows, boxcols = bounding_roi(rois)
+    data, hdrs = fitsloader.load_channels(fitsfile, channels, boxrows, boxcols, headers=True)
+
+    stats = rois_stats(data, rois, axis, percentiles, median)
+    if headers:
+        return stats, hdrs
+
+    return stats
+
+
+def raft_stats(fitsfiles, rois, channels=range(16), percentiles=(), median=True):
+    """
+    Table of statistics over regions of interest, for all channels of a list of FITS files,
+    with a single read per file. Statistics of files that cannot be read are NaN.
+    :param fitsfiles: file list
+    :param rois: list of (ROIrows, ROIcols) slices
+    :param channels:
+    :param percentiles: see channel_stats()
+    :param median: see channel_stats()
+    :return: np.recarray with one row per (file, ROI, channel) in this order,
+    fields 'file', 'roi', 'channel' (indices) and statistics from stats_names()
+    """
+    channels = list(channels)
+    names = stats_names(percentiles, median)
+    dtype = [('file', np.int32), ('roi', np.int32), ('channel', np.int32)] + [(n, np.float64) for n in names]
+    table = np.zeros((len(fitsfiles), len(rois), len(channels)), dtype=dtype).view(np.recarray)
+    table['file'] = np.arange(len(fitsfiles))[:, np.newaxis, np.newaxis]
+    table['roi'] = np.arange(len(rois))[np.newaxis, :, np.newaxis]
+    table['channel'] = channels
+
+    boxrows, boxcols = bounding_roi(rois)
+    for num, fl in enumerate(fitsfiles):
+        data = fitsloader.try_load_channels(fl, channels, boxrows, boxcols)
+        if data is None:
+            for n in names:
+                table[n][num] = np.nan
+            continue
+        for iroi, roistats in enumerate(rois_stats(data, rois, percentiles=percentiles, median=median)):
+            for n in names:
+                table[n][num, iroi] = roistats[n]
+
+    return table.ravel()
+
+
 def repr_stats(fitsfile, recalc=False, ROI1rows=slice(100, 1900), ROI1cols=slice(20, 500),
                ROI2rows=slice(100, 1900), ROI2cols=slice(540, 576)):
     """
@@ -50,24 +187,21 @@ def repr_stats(fitsfile, recalc=False, ROI1rows=slice(100, 1900), ROI1cols=slice
     :return:
     """
 
-    hdulist = pyfits.open(fitsfile)
     statstr = ""
     if recalc:
+        stats, hdrs = file_stats(fitsfile, [(ROI1rows, ROI1cols), (ROI2rows, ROI2cols)], median=False, headers=True)
         for i in range(16):
-            h = hdulist[i + 1].header
-            data = hdulist[i + 1].data
-            statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (h['EXTNAME'], data[ROI1rows, ROI1cols].mean(),
-                                                            data[ROI1rows, ROI1cols].std(),
-                                                            data[ROI2rows, ROI2cols].mean(),
-                                                            data[ROI2rows, ROI2cols].std())
+            statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (hdrs[i]['EXTNAME'], stats[0]['mean'][i], stats[0]['std'][i],
+                                                            stats[1]['mean'][i], stats[1]['std'][i])
 
     else:
+        hdulist = pyfits.open(fitsfile)
         for i in range(16):
             h = hdulist[i + 1].header
             statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (h['EXTNAME'], h['AVERAGE'], h['STDEV'],h['AVGBIAS'], h['STDVBIAS'])
 
-    hdulist.close()
-    del hdulist
+        hdulist.close()
+        del hdulist
 
     return statstr
 
@@ -80,44 +214,133 @@ def print_header_stats(fitsfile, recalc=False):
     print(repr_stats(fitsfile, recalc=recalc))
 
 
-def plothisto_overscan(fitsfile, ROIrows=slice(100, 1900), ROIcols=slice(540, 576)):
+def channel_histograms(data):
     """
-    Display distribution of data in overscan region for each channel of a CCD file.
-    :param fitsfile:
-    :return:
+    Histograms of all channels at once, one bin per ADU value, from a single np.bincount
+    over the offsets of the values from the minimum of their channel.
+    Non-integer data are rounded.
+    :param data: np.array (channel, ...)
+    :return: tuple (counts np.array (channel, bins), offsets np.array (channel,)):
+    counts[c, j] is the number of pixels of channel c with value offsets[c] + j
     """
-    hdulist = pyfits.open(fitsfile)
+    nchannels = data.shape[0]
+    data = data.reshape((nchannels, -1))
+    if data.dtype.kind not in 'iu':
+        data = np.rint(data)
+    data = data.astype(np.int64)
+
+    offsets = data.min(axis=1)
+    nbins = int((data.max(axis=1) - offsets).max()) + 1
+    index = data - offsets[:, np.newaxis]
+    index += nbins * np.arange(nchannels)[:, np.newaxis]
+    counts = np.bincount(index.ravel(), minlength=nchannels * nbins).reshape((nchannels, nbins))
 
+    return counts, offsets
+
+
+def raft_histograms(fitsfiles, ROIrows=slice(100, 1900), ROIcols=slice(540, 576), channels=range(16)):
+    """
+    Histograms (see channel_histograms()) of the ROI of all channels of a list of FITS files,
+    with the channels of all files in sequence. Files that cannot be read have empty histograms.
+    :param fitsfiles: file list
+    :return: tuple (counts np.array (file * channel, bins), offsets np.array (file * channel,))
+    """
+    channels = list(channels)
+    hists = []
+    for fl in fitsfiles:
+        data = fitsloader.try_load_channels(fl, channels, ROIrows, ROIcols)
+        if data is not None:
+            hists.append(channel_histograms(data))
+        else:
+            hists.append((np.zeros((len(channels), 1), dtype=np.int64), np.zeros(len(channels), dtype=np.int64)))
+
+    nbins = max([counts.shape[1] for counts, offsets in hists])
+    allcounts = np.zeros((len(fitsfiles) * len(channels), nbins), dtype=np.int64)
+    for num, (counts, offsets) in enumerate(hists):
+        allcounts[num * len(channels):(num + 1) * len(channels), :counts.shape[1]] = counts
+
+    return allcounts, np.concatenate([offsets for counts, offsets in hists])
+
+
+def histogram_stats(counts, offsets, percentiles=(), median=True):
+    """
+    Statistics of the data of each channel from its histogram (see channel_histograms()),
+    without going back to the data. Percentiles interpolate linearly, as np.percentile.
+    Channels with empty histograms have NaN statistics.
+    :param counts: np.array (channel, bins)
+    :param offsets: np.array (channel,)
+    :param percentiles: list of percentiles to compute (0-100)
+    :param median: if False, skips the median
+    :return: np.recarray of shape (channel,), fields from stats_names()
+    """
+    npix = counts.sum(axis=1).astype(np.float64)
+    bins = np.arange(counts.shape[1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # moments relative to the channel minimum, for precision
+        mean = np.dot(counts, bins) / npix
+        var = np.dot(counts, bins.astype(np.float64) ** 2) / npix - mean ** 2
+    values = [mean + offsets, np.sqrt(np.maximum(var, 0))]
+
+    quantiles = list(percentiles)
+    if median:
+        quantiles.insert(0, 50)
+    cumcounts = np.cumsum(counts, axis=1)
+    for q in quantiles:
+        qvalues = np.full(len(offsets), np.nan)
+        for c in np.flatnonzero(npix):
+            # position in the sorted data, value at the positions around it
+            pos = q / 100. * (npix[c] - 1)
+            low = np.searchsorted(cumcounts[c], np.floor(pos), side='right')
+            high = np.searchsorted(cumcounts[c], np.ceil(pos), side='right')
+            qvalues[c] = offsets[c] + low + (high - low) * (pos - np.floor(pos))
+        values.append(qvalues)
+
+    return np.rec.fromarrays(values, names=stats_names(percentiles, median))
+
+
+def plot_histograms(counts, offsets, titles):
+    """
+    Draws precomputed histograms (see channel_histograms()) of 16 channels, one bin per ADU value.
+    :param counts: np.array (16, bins)
+    :param offsets: np.array (16,)
+    :param titles: list of 16 titles
+    :return: figure
+    """
     fig, axes = plt.subplots(nrows = 4, ncols = 4, figsize=(13, 9))
-    #color_idx = [plt.cm.jet(i) for i in np.linspace(0, 1, 16)]
 
-    # single CCD plot
     for i in range(16):
-        h = hdulist[i + 1].header
-        d = hdulist[i + 1].data[ROIrows , ROIcols].flatten()
-        #print h['EXTNAME'], h['AVGBIAS'], d.mean(), h['STDVBIAS'], d.std()
-
-        ax = axes[i / 4, i % 4]
-
-        # the histogram of the data
-        # one bin per value
-        num_bins = np.amax(d) - np.amin(d)
-        n, bins, patches = ax.hist(d, num_bins)
-        #print bins[num_bins/2 : num_bins/2 + 10]
-        if i/4 == 3:
+        ax = axes[i // 4, i % 4]
+        # drops the empty bins at the end
+        nbins = np.flatnonzero(counts[i])[-1] + 1 if counts[i].any() else 1
+        edges = offsets[i] + np.arange(nbins + 1)
+        ax.hist(edges[:-1], edges, weights=counts[i, :nbins])
+        if i // 4 == 3:
             ax.set_xlabel('ADU')
-        if i%4 == 0:
+        if i % 4 == 0:
             ax.set_ylabel('Number of pixels')
-        ax.set_title(h['EXTNAME'])
+        ax.set_title(titles[i])
+
+    return fig
+
 
-    hdulist.close()
-    del hdulist
+def plothisto_overscan(fitsfile, ROIrows=slice(100, 1900), ROIcols=slice(540, 576)):
+    """
+    Display distribution of data in overscan region for each channel of a CCD file.
+    :param fitsfile:
+    :return: histograms, as tuple (counts, offsets) (see channel_histograms())
+    """
+    data, hdrs = fitsloader.load_channels(fitsfile, range(16), ROIrows, ROIcols, headers=True)
+    counts, offsets = channel_histograms(data)
+
+    plot_histograms(counts, offsets, [h['EXTNAME'] for h in hdrs])
 
     datadir, dataname = os.path.split(fitsfile)
     dataname = os.path.splitext(dataname)[0]
     plt.savefig(os.path.join(datadir, "histoverscan-%s.png" % dataname))
     plt.show()
 
+    return counts, offsets
+
 
 def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
     """
@@ -127,9 +350,14 @@ def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
     """
     outfile = open(os.path.join(datadir, 'average1D.txt'), 'w')
 
+    if axis == 0:
+        rois = [(ROI, slice(None))]
+    else:
+        rois = [(slice(None), ROI)]
+
     for num, hfile in enumerate(listfile):
         try:
-            h = pyfits.open(os.path.join(datadir, hfile))
+            stats = file_stats(os.path.join(datadir, hfile), rois, axis=axis, median=False)[0]
         except:
             continue
 
@@ -137,29 +365,18 @@ def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
             outfile.write('%s-%02d\t\t' % (listsensor[num], channel))
         outfile.write('\n')
 
-        #print h[1].data.shape
-        imax = h[1].data.shape[0 if axis else 1]
-        linedata = np.zeros((16, imax))
-        linestd = np.zeros((16, imax))
-
-        for channel in range(16):
-            if axis == 0:
-                linedata[channel, :] = h[channel + 1].data[ROI, :].mean(axis=axis)
-                linestd[channel, :] = h[channel + 1].data[ROI, :].std(axis=axis)
-            else:
-                linedata[channel, :] = h[channel + 1].data[:, ROI].mean(axis=axis)
-                linestd[channel, :] = h[channel + 1].data[:, ROI].std(axis=axis)
-            # option to normalize
-            if norm:
-                linedata[channel, :] = linedata[channel, :] - linedata[channel, -30:].mean()
+        linedata = stats['mean']
+        linestd = stats['std']
+        imax = linedata.shape[1]
+        # option to normalize
+        if norm:
+            linedata = linedata - linedata[:, -30:].mean(axis=1)[:, np.newaxis]
 
         for i in range(imax):
             for channel in range(16):
                 outfile.write("%.2f\t%.2f\t" % (linedata[channel, i], linestd[channel, i] ))
             outfile.write('\n')
 
-        h.close()
-        del h
     outfile.close()
 
 
@@ -203,41 +420,110 @@ def roistats_raft(raftsfits, ROIrows=slice(100, 1900), ROIcols=slice(530, 576)):
     :param raftsfits: file list
     :return:
     """
-    allmean = np.zeros(16 * len(raftsfits))
-    allstd = np.zeros(16 * len(raftsfits))
-
-    for num, fl in enumerate(raftsfits):
-        try:
-            h = pyfits.open(fl)
-        except:
-            continue
-        for i in range(1, 17):
-            allmean[num * 16 + i - 1] = h[i].data[ROIrows, ROIcols].mean()
-            allstd[num * 16 + i - 1] = h[i].data[ROIrows, ROIcols].std()
-        h.close()
-        del h
+    table = raft_stats(raftsfits, [(ROIrows, ROIcols)], median=False)
+    # unreadable files as zeros
+    allmean = np.nan_to_num(table['mean'])
+    allstd = np.nan_to_num(table['std'])
 
     return allmean, allstd
 
 
-def corrcoef_raft(raftsfits, ROIrows=slice(10, 1990), ROIcols=slice(512, 521)):
+class CovarianceAccumulator(object):
+    """
+    Streaming covariance between channels: sums and cross-products are accumulated
+    block of pixels by block of pixels, so that the data never has to be held whole.
+    Data are shifted by the mean of the first block of each channel before accumulating,
+    to limit the loss of precision of the sum of squares.
+    """
+
+    def __init__(self, nchannels):
+        self.nchannels = nchannels
+        self.count = 0
+        self.shift = None
+        self.sums = np.zeros(nchannels)
+        self.products = np.zeros((nchannels, nchannels))
+
+    def add(self, block):
+        """
+        Accumulates a block of pixels.
+        :param block: np.array (nchannels, pixels), or with more dimensions (raveled after the first)
+        :return:
+        """
+        x = block.reshape((self.nchannels, -1)).astype(np.float64)
+        if x.shape[1] == 0:
+            return
+        if self.shift is None:
+            self.shift = x.mean(axis=1)
+        x -= self.shift[:, np.newaxis]
+        self.count += x.shape[1]
+        self.sums += x.sum(axis=1)
+        self.products += np.dot(x, x.T)
+
+    def mean(self):
+        return self.shift + self.sums / self.count
+
+    def covariance(self):
+        """
+        Covariance matrix, normalized as np.cov (N-1).
+        """
+        if self.count < 2:
+            raise ValueError('Covariance needs at least 2 pixels, got %d' % self.count)
+        return (self.products - np.outer(self.sums, self.sums) / self.count) / (self.count - 1)
+
+    def corrcoef(self):
+        """
+        Correlation coefficients matrix, as np.corrcoef.
+        """
+        c = self.covariance()
+        stddev = np.sqrt(np.diag(c))
+        c /= stddev[:, np.newaxis]
+        c /= stddev[np.newaxis, :]
+        np.clip(c, -1, 1, out=c)
+
+        return c
+
+
+def corrcoef_raft(raftsfits, ROIrows=slice(10, 1990), ROIcols=slice(512, 521), rowblock=128, nthreads=None):
     """
     Correlation over one or more CCDs. Original from Paul, expanded for several CCDs and streamlined.
+    Files are kept open, and the ROI is read by blocks of lines from all files in parallel
+    and accumulated (see CovarianceAccumulator), so that memory does not grow with the size of the ROI.
     :param raftsfits: file list
+    :param ROIrows: slice
+    :param ROIcols: slice
+    :param rowblock: number of lines per block (see fitsloader.row_blocks)
+    :param nthreads: number of threads reading files (default: one per file, up to the number of CPUs)
     :return:
     """
-    stackh = []
-    #nccd = len(raftsfits)
-
-    for fl in raftsfits:
-        h = pyfits.open(fl)
-        for i in range(1, 17):
-            stackh.append(h[i].data[ROIrows, ROIcols].ravel())
-        h.close()
-        del h
-    stackh = np.stack(stackh)
-
-    a = np.corrcoef(stackh)
+    nccd = len(raftsfits)
+    acc = CovarianceAccumulator(16 * nccd)
+    readers = []
+    block = {}
+
+    def load_file(num):
+        readers[num].read(range(16), block['rows'], ROIcols, out=block['data'][num * 16:(num + 1) * 16])
+
+    pool = ThreadPool(nthreads or min(nccd, multiprocessing.cpu_count()))
+    try:
+        for fl in raftsfits:
+            readers.append(fitsloader.ChannelReader(fl))
+        nlines, ncolumns = readers[0].shape()
+        # type of the data from a single pixel
+        dtype = readers[0].read([0], slice(0, 1), slice(0, 1)).dtype
+        ncols = len(range(*ROIcols.indices(ncolumns)))
+
+        for rows in fitsloader.row_blocks(ROIrows, nlines, rowblock, readers[0].tile_rows()):
+            block['rows'] = rows
+            block['data'] = np.empty((16 * nccd, rows.stop - rows.start, ncols), dtype=dtype)
+            pool.map(load_file, range(nccd))
+            acc.add(block['data'])
+    finally:
+        pool.close()
+        pool.join()
+        for reader in readers:
+            reader.close()
+
+    a = acc.corrcoef()
     # a.shape is (nccd * 16, nccd * 16)
     return a
 
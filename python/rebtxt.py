@@ -5,6 +5,7 @@
 # TXT assembler-style IO
 #
 from __future__ import print_function
+import sys
 from sequencer import *
 import grammar
 
@@ -12,7 +13,7 @@ class TxtParser(object):
 
     time_units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1}
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, cachedir=None):
 
         self.channels_desc = {}
         self.channels = {}
@@ -28,6 +29,7 @@ class TxtParser(object):
         self.pointers = {}
         self.pointers_desc = {}
         self.verbose = verbose
+        self.cachedir = cachedir  # on-disk parse cache, see grammar.parse_file_cached()
 
     def process_number(self, s):
         ss = s.strip()
@@ -215,7 +217,7 @@ class TxtParser(object):
 
                 islice += 1
                 if islice > 15:
-                    print('Warning: too many slices in function %s' % name)
+                    print('Warning: too many slices in function %s' % name, file=sys.stderr)
                     break
 
             function.timelengths = dict(timelengths)
@@ -378,7 +380,7 @@ class TxtParser(object):
         for ptrname in self.pointers:
             seq_pointer = self.pointers[ptrname]
             if seq_pointer.pointer_type == 'PTR_FUNC':
-                if not self.functions_desc.has_key(seq_pointer.target):
+                if seq_pointer.target not in self.functions_desc:
                     raise ValueError("Pointer to undefined function %s" %
                                      seq_pointer.target)
                 seq_pointer.value = self.functions_desc[seq_pointer.target]['idfunc']
@@ -415,23 +417,25 @@ class TxtParser(object):
 
     def parse_file(self, txtfile):
         # parser manages includes of other files and fuses dictionaries
-        result = grammar.parse_file(txtfile, self.verbose)
+        result = grammar.parse_file_cached(txtfile, self.verbose, self.cachedir)
 
         return self.parse_result(result)
 
 
 # @classmethod
 # def fromxmlfile(cls, xmlfile):
-def fromtxtfile(txtfile, verbose=True):
+def fromtxtfile(txtfile, verbose=True, cachedir=None):
     """
     Create and return a Sequencer instance from a text file.
     Raise an exception if the syntax is wrong.
+    If cachedir is given (or the SEQ_CACHE_DIR environment variable is set), parse results
+    are cached on disk and reused as long as the file and its includes are unchanged.
     """
 
     functions = {}
     parameters = {}
 
-    parser = TxtParser(verbose=verbose)
+    parser = TxtParser(verbose=verbose, cachedir=cachedir)
     ( prg,
       functions_desc,
       parameters_desc,
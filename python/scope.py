@@ -7,6 +7,7 @@
 # 20161205: C. Juramy, initialized from LPNHE bench code.
 # 20170316: added more options for plots
 # 20170320: added management for file format: raw or fits
+# 20261018: memory-mapped reader for raw files (RawScanFile), shared FITS loader, ROI at read time
 #
 #
 # Syntax as main:
@@ -28,6 +29,7 @@ from matplotlib import pyplot as plt
 
 # add sequencer reading method
 import rebtxt
+import fitsloader
 
 # global for path to sequencer file
 seqpath = "/Users/nayman/Documents/REB/TS8/sequencer-files"
@@ -54,13 +56,98 @@ def set_legend_outside(ax):
     plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
 
 
-def get_scandata_fromfile(inputfile, datadir='', selectchannels=None):
+class RawScanFile(object):
+    """
+    Lazy (channel, line, column) view of a raw REB scan dump, memory-mapped: data is only read
+    (and its 18-bit sign convention fixed) for the selected channels and the lines requested.
+    The file holds 32 bits samples interleaved by channel, lines of linelength columns
+    (an incomplete last line is dropped).
+    """
+
+    def __init__(self, filename, selectchannels=None, nchannels=48, linelength=256):
+        """
+        :param filename:
+        :param selectchannels: REB channels (0-47) in the view. All if None.
+        :param nchannels: number of channels in the file
+        :param linelength: number of columns per line
+        """
+        self.filename = filename
+        self.nchannels = nchannels
+        self.linelength = linelength
+        if selectchannels is None:
+            self.channels = np.arange(nchannels)
+        else:
+            self.channels = np.array(list(selectchannels), dtype=int)
+
+        raw = np.memmap(filename, dtype=np.dtype('i4'), mode='r')
+        self.nlines = raw.shape[0] // (nchannels * linelength)
+        # temporary fix for missing last pixel
+        self.rawview = raw[:self.nlines * linelength * nchannels].reshape(self.nlines, linelength, nchannels)
+
+    @property
+    def shape(self):
+        return len(self.channels), self.nlines, self.linelength
+
+    def __len__(self):
+        return len(self.channels)
+
+    @staticmethod
+    def fix_values(rawdata):
+        """
+        For 18-bit data: negative numbers are translated, sign is inverted on all data,
+        also make all values positive.
+        0 -> 1FFFF, 1FFFF -> 0, 20000 -> 3FFFF, 3FFFF -> 20000
+        This works by XORing the lowest 17 bits.
+        """
+        return np.bitwise_xor(rawdata, 0x1FFFF)
+
+    def __getitem__(self, key):
+        """
+        Reads the (channel, line, column) selection, channels being numbered within the view.
+        :return: np.array
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+
+        chans = self.channels[key[0]]
+        data = self.rawview[key[1], key[2]][..., chans]
+        if np.ndim(chans):
+            # puts the channel as first axis
+            data = np.moveaxis(data, -1, 0)
+
+        return self.fix_values(np.asarray(data))
+
+    def iter_blocks(self, nlines=256):
+        """
+        Streams the view by blocks of lines.
+        :param nlines: number of lines per block
+        :return: generator of (first line, np.array of shape (nchannels, nlines, columns))
+        """
+        for start in range(0, self.nlines, nlines):
+            yield start, self[:, start:start + nlines]
+
+    def to_array(self, nlines=256):
+        """
+        Reads the whole view into a single array, block by block.
+        :return: np.array of shape (nchannels, lines, columns)
+        """
+        chandata = np.empty(self.shape, dtype=self.rawview.dtype)
+        for start, block in self.iter_blocks(nlines):
+            chandata[:, start:start + block.shape[1]] = block
+
+        return chandata
+
+
+def get_scandata_fromfile(inputfile, datadir='', selectchannels=None, ROIrows=slice(None), ROIcols=slice(None)):
     """
     Reads data from the file, sets it straight if raw values, returns 3D array of (scan-)image data.
     We will look at file extension to guess what it it and how it is organized.
     :param selectchannels: which REB channel we want to include (numbered 0-15, 0-47 if full REB file). All if None.
     :param datadir: optional, directory where data is stored
     :param inputfile: the file where image data is stored. Needs full path if datadir is not provided.
+    :param ROIrows: optional, lines to read
+    :param ROIcols: optional, columns to read
     :return:
     """
     if os.path.splitext(inputfile)[1] in [".fits", ".fz"]:
@@ -69,37 +156,15 @@ def get_scandata_fromfile(inputfile, datadir='', selectchannels=None):
         else:
             displayamps = selectchannels
 
-        hdulist = fits.open(os.path.join(datadir, inputfile))
-        imgdata = []
-        for i in displayamps:
-            imgdata.append(hdulist[i + 1].data)
-            #print hdulist[i+1].data.shape
-        hdulist.close()
-        del hdulist  # clean-up
-
-        chandata = np.stack(imgdata)
+        chandata = fitsloader.load_channels(os.path.join(datadir, inputfile), displayamps, ROIrows, ROIcols)
 
     else:
-        nchannels = 48
-        if selectchannels is None:
-            displayamps = range(nchannels)
+        # assumes this is a scan image, read through memory map for the selected channels only
+        rawscan = RawScanFile(os.path.join(datadir, inputfile), selectchannels)
+        if ROIrows == slice(None) and ROIcols == slice(None):
+            chandata = rawscan.to_array()
         else:
-            displayamps = selectchannels
-
-        dt = np.dtype('i4')
-        buff = np.fromfile(os.path.join(datadir, inputfile), dtype=dt)
-        # for 18-bit data:
-        # negative numbers are translated, sign is inverted on all data, also make all values positive
-        # 0 -> 1FFFF, 1FFFF -> 0, 20000 -> 3FFFF, 3FFFF -> 20000
-        # this works by XORing the lowest 17 bits
-        rawdata = np.bitwise_xor(buff, 0x1FFFF)
-        # reshape by channel
-        length = rawdata.shape[0] / nchannels
-        # temporary fix for missing last pixel
-        rawdata = rawdata[:256 * (length/256) * nchannels]
-        rawdata = rawdata.reshape(length/256, 256, nchannels)  # assumes this is a scan image
-
-        chandata = np.transpose(rawdata[:, :, displayamps], (2, 0, 1))  # puts the channel as first axis
+            chandata = rawscan[:, ROIrows, ROIcols]
         # TODO: match the order from the fits file
 
     #print chandata.shape
@@ -140,10 +205,10 @@ def plot_scan_states(ax, seq, readfunction, offset=0, extend=1, marktransitions=
 
     # creates waveform for each clock with matching timing
     clocktransitions = np.array([0, 255 + 256 * (extend - 1)])  # add boundaries of scan
+    # states of all clocks at once, one column per cycle
+    allstates = funcscope.scope_array([seq.channels[clock] for clock in clocklist]).astype(int)
     for i, clock in enumerate(clocklist):
-        clockline = seq.channels[clock]
-        states = funcscope.scope(clockline)
-        scanstates = np.tile(np.array(states), 3 * extend)[offset:offset + 256 * extend]
+        scanstates = np.tile(allstates[i], 3 * extend)[offset:offset + 256 * extend]
         #print find_transition_index(scanstates)
         clocktransitions = np.concatenate((clocktransitions, find_transition_index(scanstates)))
         ax.plot(scanstates * 0.8 + i, drawstyle='steps-post')
@@ -12,15 +12,22 @@
 # Authors: Laurent Le Guillou, Claire Juramy
 #
 # ========================================================================
+from __future__ import print_function
 
 import sys
 import os.path
 import datetime
+import glob
+import time
+import multiprocessing
+import json
+import struct
 
 import optparse
 
 # from lsst.camera.generic.rebtxt import *
 from rebtxt import *
+import grammar
 
 # ========================================================================
 
@@ -32,98 +39,316 @@ outputs_base_addr = 0x100000
 slices_base_addr  = 0x200000
 program_base_addr = 0x300000
 
+def default_compname(seqfile):
+    """
+    Default name of the compiled file (in the current directory).
+    """
+    compfile = os.path.basename(seqfile).replace(".seq", ".compiled").replace(".txt", ".compiled")
+    if compfile == os.path.basename(seqfile):
+        compfile = os.path.basename(seqfile) + ".compiled"
+
+    return compfile
+
+
 def write_compfile(seq, seqfile, compname=''):
 
     # creating output name
     if compname:
         compfile = compname
     else:  # default name
-        compfile = os.path.basename(seqfile).replace(".seq", ".compiled").replace(".txt", ".compiled")
-        if compfile == os.path.basename(seqfile):
-            compfile = os.path.basename(seqfile) + ".compiled"
+        compfile = default_compname(seqfile)
 
     compf = open(compfile, "w")
 
     # Small header to described the file
 
-    print >> compf, "## LSST REB compiled sequencer file"
-    print >> compf, "## REB: REB5"
-    print >> compf, "## Source:", seqfile
-    print >> compf, "## Compilation date:", datetime.datetime.utcnow()
-    # print >> compf, "## Compiler:", "python seqcompiler", version
-    print >> compf, "## Compiler:", "python seqcompiler", version
-    print >> compf, "## Compiler authors:", "L. Le Guillou, C. Juramy"
+    print("## LSST REB compiled sequencer file", file=compf)
+    print("## REB: REB5", file=compf)
+    print("## Source:", seqfile, file=compf)
+    print("## Compilation date:", datetime.datetime.utcnow(), file=compf)
+    # print("## Compiler:", "python seqcompiler", version, file=compf)
+    print("## Compiler:", "python seqcompiler", version, file=compf)
+    print("## Compiler authors:", "L. Le Guillou, C. Juramy", file=compf)
 
     # Now writing the functions
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [functions]"
-    print >> compf, "##"
+    print("## ======================================================", file=compf)
+    print("# [functions]", file=compf)
+    print("##", file=compf)
 
-    for func_id in xrange(len(seq.functions)):
+    for func_id in range(len(seq.functions)):
         func = seq.functions[func_id]
         funcbc = func.bytecode(func_id,
                                slices_base_addr = slices_base_addr,
                                outputs_base_addr = outputs_base_addr)
-        print >> compf, "## ------------------------------------------------------"
-        print >> compf, "## function: #%d" % func_id
-        print >> compf, "##   name: ", func.name
-        print >> compf, "##   description: ", func.fullname
-        print >> compf, "##   execution time: ", func.total_time()
-        print >> compf, "##"
-
-        addrs = funcbc.keys()
-        addrs.sort()
+        print("## ------------------------------------------------------", file=compf)
+        print("## function: #%d" % func_id, file=compf)
+        print("##   name: ", func.name, file=compf)
+        print("##   description: ", func.fullname, file=compf)
+        print("##   execution time: ", func.total_time(), file=compf)
+        print("##", file=compf)
+
+        addrs = sorted(funcbc.keys())
         for addr in addrs:
-            print >> compf, "0x%06x: 0x%08x" % (addr, funcbc[addr])
+            print("0x%06x: 0x%08x" % (addr, funcbc[addr]), file=compf)
 
     # Now writing the subroutines and mains
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [subroutines/mains]"
-    print >> compf, "##"
+    print("## ======================================================", file=compf)
+    print("# [subroutines/mains]", file=compf)
+    print("##", file=compf)
 
-    print >> compf, "## ------------------------------------------------------"
+    print("## ------------------------------------------------------", file=compf)
 
-    print >> compf, "## Main/Subroutine relative addresses"
-    print >> compf, "## (program base addr 0x300000)"
-    print >> compf, "## "
-    for name, reladdr in seq.program.subroutines.iteritems():
-        print >> compf, "# %s: 0x%06x" % (name, reladdr)
+    print("## Main/Subroutine relative addresses", file=compf)
+    print("## (program base addr 0x300000)", file=compf)
+    print("## ", file=compf)
+    for name, reladdr in seq.program.subroutines.items():
+        print("# %s: 0x%06x" % (name, reladdr), file=compf)
 
-    print >> compf, "## ------------------------------------------------------"
+    print("## ------------------------------------------------------", file=compf)
 
     progbc = seq.program.bytecode(program_base_addr = program_base_addr)
-    addrs = progbc.keys()
-    addrs.sort()
+    addrs = sorted(progbc.keys())
     for addr in addrs:
-        print >> compf, "0x%06x: 0x%08x" % (addr, progbc[addr])
+        print("0x%06x: 0x%08x" % (addr, progbc[addr]), file=compf)
 
     # Now writing the pointers
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [pointers]"
-    print >> compf, "##"
+    print("## ======================================================", file=compf)
+    print("# [pointers]", file=compf)
+    print("##", file=compf)
 
     ptrs = seq.pointers
 
-    for name, ptr in ptrs.iteritems():
-        print >> compf, "0x%06x: 0x%06x   # %s:  %s" % (ptr.address,
-                                                        ptr.value,
-                                                        ptr.pointer_type,
-                                                        ptr.name)
+    for name, ptr in ptrs.items():
+        print("0x%06x: 0x%06x   # %s:  %s" % (ptr.address,
+                                               ptr.value,
+                                               ptr.pointer_type,
+                                               ptr.name), file=compf)
 
-    print >> compf, "## ======================================================"
+    print("## ======================================================", file=compf)
 
     compf.close()
 
     return compfile
 
+# ========================================================================
+
+# Binary compiled file: magic string, header length (uint32 little-endian),
+# JSON header, then the blocks of the memory image as little-endian uint32,
+# in the order given in the header.
+
+binary_magic = b'REBSEQB1'
+
+
+def default_binname(seqfile):
+    """
+    Default name of the binary compiled file (in the current directory).
+    """
+    return os.path.splitext(default_compname(seqfile))[0] + ".seqbin"
+
+
+def write_binfile(seq, seqfile, binname=''):
+    """
+    Writes the FPGA memory image of the sequencer to a binary compiled file.
+    The header holds the source name and hash, the compilation date,
+    the main/subroutine address table, the list of blocks, and what is needed
+    to decompile the image (names of functions, pointers and channels, parameters).
+    """
+    if binname:
+        binfile = binname
+    else:  # default name
+        binfile = default_binname(seqfile)
+
+    with open(seqfile) as f:
+        source_hash = grammar.file_digest(f.read())
+
+    image = seq.memory_image()
+    bases = image.block_bases()
+
+    header = {'source': seqfile,
+              'source_sha1': source_hash,
+              'date': datetime.datetime.utcnow().isoformat(),
+              'compiler': 'python seqcompiler %s' % version,
+              'subroutines': dict(seq.program.subroutines),
+              'blocks': [[b, bases.get(b), getattr(image, b).size] for b in image.Blocks],
+              'functions': [[func_id, func.name, func.fullname, len(func.timelengths)]
+                            for func_id, func in sorted(seq.functions.items())],
+              'pointers': [[name, ptr.pointer_type] for name, ptr in seq.pointers.items()],
+              'channels': dict([(c, seq.channels[c]) for c in range(32) if seq.channels.has_key(c)]),
+              'parameters': dict(seq.parameters)}
+    hbytes = json.dumps(header, sort_keys=True).encode('utf-8')
+
+    with open(binfile, 'wb') as binf:
+        binf.write(binary_magic)
+        binf.write(struct.pack('<I', len(hbytes)))
+        binf.write(hbytes)
+        for b in image.Blocks:
+            binf.write(getattr(image, b).astype('<u4').tobytes())
+
+    return binfile
+
+
+def read_binfile(binfile):
+    """
+    Reads a binary compiled file written by write_binfile().
+    Returns the header (dictionary) and the memory image (MemoryImage).
+    """
+    with open(binfile, 'rb') as binf:
+        data = binf.read()
+
+    if data[:len(binary_magic)] != binary_magic:
+        raise ValueError('Not a binary compiled sequencer file: %s' % binfile)
+    pos = len(binary_magic)
+    hlen = struct.unpack('<I', data[pos:pos + 4])[0]
+    pos += 4
+    header = json.loads(data[pos:pos + hlen].decode('utf-8'))
+    pos += hlen
+
+    blocks = {}
+    for name, base, size in header['blocks']:
+        if pos + 4 * size > len(data):
+            raise ValueError('Truncated binary compiled sequencer file: %s' % binfile)
+        blocks[name] = np.frombuffer(data, dtype='<u4', count=size, offset=pos).astype(np.uint32)
+        pos += 4 * size
+
+    image = MemoryImage(*[blocks[b] for b in MemoryImage.Blocks])
+
+    return header, image
+
+# ========================================================================
+
+def find_seqfiles(patterns):
+    """
+    Expands a list of directories (all *.seq files below them) and
+    file names or glob patterns into a sorted list of sequencer files.
+    """
+    seqfiles = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dirpath, dirnames, filenames in os.walk(pattern):
+                for f in filenames:
+                    if f.endswith(".seq"):
+                        seqfiles.add(os.path.join(dirpath, f))
+        else:
+            seqfiles.update(glob.glob(pattern))
+
+    return sorted(seqfiles)
+
+
+def batch_map(func, tasks, nprocs=None):
+    """
+    Applies func to all tasks in a pool of processes (nprocs, default: number of CPUs).
+    Tasks are handed out to the workers by blocks of consecutive tasks, so that
+    consecutive files of a directory share the [includes] parsed by a worker.
+    Returns the list of results, in the order of the tasks.
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    chunksize = max(1, len(tasks) // (4 * nprocs))
+
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        results = pool.map(func, tasks, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def compile_task(task):
+    """
+    Compiles a single file for batch_compile() (runs in a worker process).
+    Returns (source, compiled file, error message, duration in s).
+    """
+    seqfile, compfile, cachedir, binary = task
+
+    start = time.time()
+    try:
+        seq = Sequencer.fromtxtfile(seqfile, verbose=False, cachedir=cachedir)
+        if binary:
+            write_binfile(seq, seqfile, binname=compfile)
+        else:
+            write_compfile(seq, seqfile, compname=compfile)
+        error = ''
+    except Exception as e:
+        compfile = ''
+        error = '%s: %s' % (type(e).__name__, e)
+
+    return seqfile, compfile, error, time.time() - start
+
+
+def batch_compile(patterns, outdir='', nprocs=None, cachedir=None, binary=False):
+    """
+    Compiles all sequencer files given as directories or glob patterns,
+    in a pool of processes. Compiled files are written next to their source,
+    or in outdir if given, in the same tree of subdirectories as the sources below
+    their common directory (binary compiled files if binary is True).
+    Raises ValueError if two sources would be compiled to the same file.
+    Each worker keeps the parsed [includes] in memory (and on disk through cachedir
+    if given) and shares them across its block of files (see batch_map()).
+    Returns the list of (source, compiled file, error message, duration).
+    """
+    seqfiles = find_seqfiles(patterns)
+    if not seqfiles:
+        return []
+
+    if binary:
+        namefunc = default_binname
+    else:
+        namefunc = default_compname
+
+    if outdir:
+        # keeps the tree of sources below their common directory
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in seqfiles])
+        compfiles = [os.path.join(outdir, os.path.relpath(os.path.dirname(os.path.abspath(f)), root), namefunc(f))
+                     for f in seqfiles]
+    else:
+        compfiles = [os.path.join(os.path.dirname(f), namefunc(f)) for f in seqfiles]
+    compfiles = [os.path.normpath(f) for f in compfiles]
+
+    # e.g. seq.seq and seq.txt in the same directory
+    targets = {}
+    for seqfile, compfile in zip(seqfiles, compfiles):
+        if compfile in targets:
+            raise ValueError('Both %s and %s would be compiled to %s' % (targets[compfile], seqfile, compfile))
+        targets[compfile] = seqfile
+
+    for d in set([os.path.dirname(f) for f in compfiles]):
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+
+    tasks = [(seqfile, compfile, cachedir, binary) for seqfile, compfile in zip(seqfiles, compfiles)]
+
+    return batch_map(compile_task, tasks, nprocs)
+
+
+def print_batch_summary(results, out=sys.stdout):
+    """
+    Prints table of batch compilation results: status, duration, file, output or error.
+    """
+    nfailed = 0
+    print("%-6s %9s  %s" % ("status", "time (s)", "file"), file=out)
+    for seqfile, compfile, error, duration in results:
+        if error:
+            nfailed += 1
+            print("%-6s %9.3f  %s\n                  %s" % ("FAIL", duration, seqfile, error), file=out)
+        else:
+            print("%-6s %9.3f  %s -> %s" % ("OK", duration, seqfile, compfile), file=out)
+
+    print("## %d files compiled, %d failed, %.2f s total compilation time" %
+          (len(results) - nfailed, nfailed, sum([r[3] for r in results])), file=out)
+
+    return nfailed
+
 # ========================================================================
 if __name__ == '__main__':
     parser = optparse.OptionParser(usage = \
     """
-    %prog [-v] <sequencer-file> [<compiled-file>]
+    %prog [-v] [-B] <sequencer-file> [<compiled-file>]
+    %prog -b [-B] [-j <nprocs>] [-o <output-dir>] <dir|glob> [<dir|glob> ...]
 
     Sequencer compiler for the LSST REB FPGA.
 
@@ -134,9 +359,27 @@ if __name__ == '__main__':
 
     The LSST REB sequencer programming language is specified
     in LCA-XXXXX: 'LSST REB Sequencer Language - Use Manual'.
+
+    In batch mode (-b), all *.seq files in the given directories,
+    or matching the given patterns, are compiled in parallel and
+    a summary table is printed.
     """)
     parser.add_option('-v', '--verbose', default=True, action='store_true',
                       help='Verbose run')
+    parser.add_option('-c', '--cache', default=False, action='store_true',
+                      help='Reuse parse results cached in %s' % grammar.default_cachedir)
+    parser.add_option('-b', '--batch', default=False, action='store_true',
+                      help='Batch compilation of directories or glob patterns')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Number of processes in batch mode (default: number of CPUs)')
+    parser.add_option('-o', '--outdir', default='',
+                      help='Output directory in batch mode, keeping the tree of sources (default: next to each source)')
+    parser.add_option('-B', '--binary', default=False, action='store_true',
+                      help='Write binary compiled files (*.seqbin) instead of text')
+    parser.add_option('-n', '--npz', default='',
+                      help='Also export the FPGA memory image to the given .npz file (single file only)')
+    parser.add_option('-r', '--raw', default='',
+                      help='Also export the FPGA memory image as raw binary blocks <RAW>.<block>.bin (single file only)')
 
     (options, args) = parser.parse_args()
 
@@ -145,10 +388,32 @@ if __name__ == '__main__':
 
     if len(args) < 1:
         # no seqfile provided
-        print >>sys.stderr, "error: no sequencer program file."
+        print("error: no sequencer program file.", file=sys.stderr)
         parser.print_help()
         sys.exit(1)
 
+    if options.cache:
+        cachedir = grammar.default_cachedir
+    else:
+        cachedir = None
+
+    if options.batch:
+        if options.npz or options.raw:
+            print("error: memory image export (-n, -r) is for a single file, not in batch mode.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            results = batch_compile(args, outdir=options.outdir, nprocs=options.jobs, cachedir=cachedir,
+                                    binary=options.binary)
+        except ValueError as e:
+            print("error: %s" % e, file=sys.stderr)
+            sys.exit(1)
+        if not results:
+            print("error: no sequencer program file found.", file=sys.stderr)
+            sys.exit(1)
+        if print_batch_summary(results):
+            sys.exit(2)
+        sys.exit(0)
+
     seqfile = args[0]
 
 
@@ -160,11 +425,20 @@ if __name__ == '__main__':
     # ========================================================================
 
     try:
-        seq = Sequencer.fromtxtfile(seqfile)  # compilation proper
+        seq = Sequencer.fromtxtfile(seqfile, cachedir=cachedir)  # compilation proper
     except:
-        print >>sys.stderr, 'error: compilation of file "%s" failed: no output.' % seqfile
+        print('error: compilation of file "%s" failed: no output.' % seqfile, file=sys.stderr)
         sys.exit(2)
 
     # Now, writing the various parts into the resulting file
-    write_compfile(seq, seqfile, compname=compfile)
-
+    if options.binary:
+        write_binfile(seq, seqfile, binname=compfile)
+    else:
+        write_compfile(seq, seqfile, compname=compfile)
+
+    if options.npz or options.raw:
+        image = seq.memory_image()
+        if options.npz:
+            image.save_npz(options.npz)
+        if options.raw:
+            image.save_raw(options.raw)
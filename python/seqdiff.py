@@ -0,0 +1,346 @@
+#! /usr/bin/env python
+#
+# LSST
+# Semantic comparison of sequencer files, on the parsed Sequencer objects.
+#
+# Reports changes of constants, functions (per time slice and per channel), pointers,
+# program structure (instructions of each main/subroutine, with symbolic names), and
+# the resulting change in duration of each main/subroutine.
+#
+# Changelog
+# 20261018: initialized.
+#
+# Syntax as main:
+# python seqdiff.py [sequencer-file.seq] [other-file.seq]
+# python seqdiff.py [sequencer-file.seq] [directory]    (all other files of the directory)
+# Example:
+# python seqdiff.py ../run5/seq-a.seq ../run5
+#
+# Syntax in a script:
+# import seqdiff
+# print(seqdiff.diff_files("seq-a.seq", "seq-b.seq"))
+from __future__ import print_function
+import sys
+import os
+import difflib
+
+import rebtxt
+import seqcompiler
+import funcindex
+
+
+class SeqDiff(object):
+    """
+    Differences between two sequencers, as lists of lines by category.
+    """
+
+    Categories = ['constants', 'functions', 'pointers', 'program', 'durations']
+
+    def __init__(self, name_a='a', name_b='b'):
+        self.name_a = name_a
+        self.name_b = name_b
+        for c in self.Categories:
+            setattr(self, c, [])
+
+    def __repr__(self):
+        s = "--- %s\n+++ %s\n" % (self.name_a, self.name_b)
+        for c in self.Categories:
+            lines = getattr(self, c)
+            if lines:
+                s += "[%s]\n" % c
+                for l in lines:
+                    s += "    %s\n" % l
+        if self.is_empty():
+            s += "no difference\n"
+
+        return s
+
+    def is_empty(self):
+        return not any([getattr(self, c) for c in self.Categories])
+
+
+def repr_value(v):
+    if isinstance(v, float):
+        return "%g" % v
+    return str(v)
+
+
+def diff_values(name, a, b, lines):
+    if a != b:
+        lines.append("%s: %s -> %s" % (name, repr_value(a), repr_value(b)))
+
+
+def diff_constants(seq_a, seq_b, lines):
+    for k in sorted(set(seq_a.parameters) | set(seq_b.parameters)):
+        diff_values(k, seq_a.parameters.get(k), seq_b.parameters.get(k), lines)
+
+
+def channel_name(seq, bit):
+    if seq.channels.has_key(bit):
+        return seq.channels[bit]
+    return str(bit)
+
+
+def diff_function(seq_a, func_a, func_b, lines):
+    """
+    Differences between two functions of the same name, per time slice and per channel.
+    """
+    name = func_a.name
+    nslices_a = len(func_a.timelengths)
+    nslices_b = len(func_b.timelengths)
+    if nslices_a != nslices_b:
+        lines.append("%s: %d -> %d slices" % (name, nslices_a, nslices_b))
+
+    for t in range(max(nslices_a, nslices_b)):
+        if t in func_a.timelengths and t in func_b.timelengths:
+            diff_values("%s slice %d duration" % (name, t), func_a.timelengths[t], func_b.timelengths[t], lines)
+
+    # per channel: slices where the output changed
+    changed = {}
+    for t in sorted(set(func_a.outputs) & set(func_b.outputs)):
+        mask = (func_a.outputs[t] ^ func_b.outputs[t]) & 0xffffffff
+        for bit in range(32):
+            if mask & (1 << bit):
+                changed.setdefault(bit, []).append(t)
+    for bit in sorted(changed):
+        lines.append("%s channel %s changed in slices %s" %
+                     (name, channel_name(seq_a, bit), ', '.join([str(t) for t in changed[bit]])))
+
+    # slices only in one of the functions: their whole waveform
+    for t in sorted(set(func_a.outputs) ^ set(func_b.outputs)):
+        if t in func_b.outputs:
+            func, status = func_b, 'added'
+        else:
+            func, status = func_a, 'removed'
+        high = [channel_name(seq_a, bit) for bit in range(32) if func.outputs[t] & (1 << bit)]
+        lines.append("%s slice %d %s: duration %s, channels high: %s" %
+                     (name, t, status, func.timelengths.get(t), ', '.join(high) or 'none'))
+
+    if func_a.total_time() != func_b.total_time():
+        lines.append("%s duration: %d -> %d cycles" % (name, func_a.total_time(), func_b.total_time()))
+
+
+def functions_by_name(seq):
+    return dict([(func.name, func) for func in seq.functions.values()])
+
+
+def diff_functions(seq_a, seq_b, lines):
+    funcs_a = functions_by_name(seq_a)
+    funcs_b = functions_by_name(seq_b)
+
+    # renamed functions: same waveform, different names
+    hashes_a = dict([(funcindex.function_hash(f), n) for n, f in funcs_a.items() if n not in funcs_b])
+    renamed = {}
+    for n, f in funcs_b.items():
+        h = funcindex.function_hash(f)
+        if n not in funcs_a and h in hashes_a:
+            renamed[hashes_a.pop(h)] = n
+
+    for name in sorted(set(funcs_a) | set(funcs_b)):
+        if name in renamed:
+            lines.append("%s: renamed to %s" % (name, renamed[name]))
+        elif name in renamed.values():
+            continue
+        elif name not in funcs_b:
+            lines.append("%s: removed" % name)
+        elif name not in funcs_a:
+            lines.append("%s: added" % name)
+        else:
+            diff_function(seq_a, funcs_a[name], funcs_b[name], lines)
+
+    # function numbers matter for pointers and for the compiled image
+    for name in sorted(set(funcs_a) & set(funcs_b)):
+        ida = seq_a.functions_desc.get(name, {}).get('idfunc')
+        idb = seq_b.functions_desc.get(name, {}).get('idfunc')
+        diff_values("%s function number" % name, ida, idb, lines)
+
+
+def diff_pointers(seq_a, seq_b, lines):
+    for name in sorted(set(seq_a.pointers) | set(seq_b.pointers)):
+        if name not in seq_b.pointers:
+            lines.append("%s: removed" % name)
+        elif name not in seq_a.pointers:
+            lines.append("%s: added" % name)
+        else:
+            pa = seq_a.pointers[name]
+            pb = seq_b.pointers[name]
+            diff_values("%s type" % name, pa.pointer_type, pb.pointer_type, lines)
+            if pa.target or pb.target:
+                diff_values("%s target" % name, pa.target, pb.target, lines)
+            else:
+                diff_values("%s value" % name, pa.value, pb.value, lines)
+
+
+def subroutine_names(seq):
+    """
+    Names of subroutines by start address (first name if several).
+    """
+    names = {}
+    for name, addr in sorted(seq.program.subroutines.items()):
+        names.setdefault(addr, name)
+    return names
+
+
+def symbolic_listing(seq, subr, names=None):
+    """
+    Instructions of a main/subroutine (not unrolled), with names instead of numbers and addresses,
+    so that listings of different files can be compared.
+    :param seq: Sequencer
+    :param subr: name of main or subroutine
+    :param names: subroutine names by address (computed if not given)
+    :return: list of strings
+    """
+    if names is None:
+        names = subroutine_names(seq)
+
+    listing = []
+    address = seq.program.subroutines[subr]
+    while address in seq.program.instructions:
+        instr = seq.program.instructions[address]
+        s = instr.name
+        if instr.opcode in instr.Call_codes:
+            if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                func = seq.functions.get(instr.function_id)
+                s += " func(%s)" % (func.name if func is not None else instr.function_id)
+            else:
+                s += " func(@%s)" % seq.pointer_name('PTR_FUNC', instr.function_id)
+            if instr.infinite_loop:
+                s += " repeat(infinity)"
+            elif instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                s += " repeat(%d)" % instr.repeat
+            else:
+                s += " repeat(@%s)" % seq.pointer_name('REP_FUNC', instr.repeat)
+        elif instr.opcode in instr.Jsr_codes:
+            if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                s += " %s" % (instr.subroutine or names.get(instr.address, '0x%03x' % instr.address))
+            else:
+                s += " @%s" % seq.pointer_name('PTR_SUBR', instr.address)
+            if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                s += " repeat(%d)" % instr.repeat
+            else:
+                s += " repeat(@%s)" % seq.pointer_name('REP_SUBR', instr.repeat)
+        listing.append(s)
+        if instr.opcode in [instr.OP_ReturnFromSubroutine, instr.OP_EndOfProgram]:
+            break
+        address += 1
+
+    return listing
+
+
+def diff_program(seq_a, seq_b, lines):
+    subrs_a = seq_a.program.subroutines
+    subrs_b = seq_b.program.subroutines
+    names_a = subroutine_names(seq_a)
+    names_b = subroutine_names(seq_b)
+
+    for name in sorted(set(subrs_a) | set(subrs_b)):
+        if name not in subrs_b:
+            lines.append("%s: removed" % name)
+        elif name not in subrs_a:
+            lines.append("%s: added" % name)
+        else:
+            listing_a = symbolic_listing(seq_a, name, names_a)
+            listing_b = symbolic_listing(seq_b, name, names_b)
+            if listing_a != listing_b:
+                lines.append("%s:" % name)
+                for l in difflib.unified_diff(listing_a, listing_b, lineterm='', n=0):
+                    if not l.startswith(('---', '+++', '@@')):
+                        lines.append("    %s" % l)
+
+
+def subroutine_durations(seq):
+    """
+    Durations (us) of all mains and subroutines, None if they cannot be computed.
+    """
+    durations = {}
+    for name in seq.program.subroutines:
+        try:
+            durations[name] = seq.timing(name, verbose=False)
+        except Exception:
+            durations[name] = None
+
+    return durations
+
+
+def diff_durations(durations_a, durations_b, lines):
+    for name in sorted(set(durations_a) & set(durations_b)):
+        da = durations_a[name]
+        db = durations_b[name]
+        if da is None or db is None:
+            diff_values("%s duration" % name, da, db, lines)
+        elif abs(da - db) > 1e-6 * max(abs(da), abs(db)):
+            lines.append("%s duration: %.2f -> %.2f us (%+.2f us)" % (name, da, db, db - da))
+
+
+def diff_sequencers(seq_a, seq_b, name_a='a', name_b='b', durations_a=None):
+    """
+    Semantic differences between two sequencers.
+    :param seq_a: Sequencer
+    :param seq_b: Sequencer
+    :param durations_a: durations of seq_a (see subroutine_durations), to reuse across comparisons
+    :return: SeqDiff
+    """
+    result = SeqDiff(name_a, name_b)
+    diff_constants(seq_a, seq_b, result.constants)
+    diff_functions(seq_a, seq_b, result.functions)
+    diff_pointers(seq_a, seq_b, result.pointers)
+    diff_program(seq_a, seq_b, result.program)
+
+    if durations_a is None:
+        durations_a = subroutine_durations(seq_a)
+    diff_durations(durations_a, subroutine_durations(seq_b), result.durations)
+
+    return result
+
+
+def diff_files(file_a, file_b):
+    """
+    Semantic differences between two sequencer files.
+    :return: SeqDiff
+    """
+    seq_a = rebtxt.Sequencer.fromtxtfile(file_a, verbose=False)
+    seq_b = rebtxt.Sequencer.fromtxtfile(file_b, verbose=False)
+
+    return diff_sequencers(seq_a, seq_b, file_a, file_b)
+
+
+def diff_directory(reffile, dirname):
+    """
+    Compares a sequencer file to all other sequencer files of a directory (and below).
+    The reference file is parsed and timed only once.
+    :return: list of SeqDiff, in the order of seqcompiler.find_seqfiles() without the reference file
+    (None for files that could not be parsed)
+    """
+    seq_a = rebtxt.Sequencer.fromtxtfile(reffile, verbose=False)
+    durations_a = subroutine_durations(seq_a)
+
+    results = []
+    for seqfile in seqcompiler.find_seqfiles([dirname]):
+        if os.path.abspath(seqfile) == os.path.abspath(reffile):
+            continue
+        try:
+            seq_b = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False)
+        except Exception:
+            seq_b = None
+        if seq_b is None:
+            print("Could not parse %s" % seqfile)
+            results.append(None)
+            continue
+        results.append(diff_sequencers(seq_a, seq_b, reffile, seqfile, durations_a))
+
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("seqdiff.py requires a sequencer file and another sequencer file or directory")
+        sys.exit()
+    reffile = sys.argv[1]
+    other = sys.argv[2]
+
+    if os.path.isdir(other):
+        for d in diff_directory(reffile, other):
+            if d is not None:
+                print(d)
+    else:
+        print(diff_files(reffile, other))
@@ -33,8 +33,7 @@ class Program(object):
     def __repr__(self):
         s = ""
 
-        addrs = self.instructions.keys()
-        addrs.sort()
+        addrs = sorted(self.instructions.keys())
 
         last_addr = None
         for addr in addrs:
@@ -55,8 +54,7 @@ class Program(object):
         """
 
         instrs = self.instructions
-        addrs = instrs.keys()
-        addrs.sort()
+        addrs = sorted(instrs.keys())
 
         bcs = {}
         for addr in addrs:
@@ -66,6 +64,15 @@ class Program(object):
 
         return bcs
 
+    def compact(self):
+        """
+        Compact representation of the program, as an array of bytecode indexed by address.
+        Built from the instructions at each call: keep it for repeated array operations
+        (see CompactProgram.bytecode()).
+        :return: CompactProgram
+        """
+        return CompactProgram.from_program(self)
+
 
 class SequencerPointer(object):
 
@@ -185,8 +192,74 @@ class SequencerPointer(object):
         return seqptr
 
 
+class PointerTable(dict):
+    """
+    Dictionary of the sequencer pointers by name, indexed by (pointer type, pointer number).
+    The index is rebuilt at the first lookup after the table is modified.
+    Call reindex() after changing the type or address of a pointer in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.index = None
+
+    def reindex(self):
+        """
+        Invalidates the (pointer type, pointer number) index.
+        :return:
+        """
+        self.index = None
+
+    def lookup(self, typeptr, numptr):
+        """
+        Returns the name of the pointer for a given pointer type and number, None if undefined.
+        :param typeptr:
+        :param numptr:
+        :return:
+        """
+        if self.index is None:
+            self.index = {}
+            for pname in self:
+                p = self[pname]
+                # first pointer defined wins, as in a sequential search
+                self.index.setdefault((p.pointer_type, p.ptr_num()), pname)
+
+        return self.index.get((typeptr, numptr))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.index = None
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.index = None
+
+    def clear(self):
+        dict.clear(self)
+        self.index = None
+
+    def pop(self, *args):
+        self.index = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.index = None
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.index = None
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.index = None
+
+
 class Instruction(object):
 
+    __slots__ = ['function_id', 'address', 'subroutine', 'unassembled',
+                 'repeat', 'infinite_loop', 'opcode', 'name']
+
     OP_CallFunction          = 0x1
     OP_CallPointerFunction   = 0x2
     OP_CallFuncPointerRepeat = 0x3
@@ -474,7 +547,7 @@ class Instruction(object):
                                    function_id=function_id,
                                    repeat=repeat)
 
-        elif opcode == cls.Jsr_codes:
+        elif opcode in cls.Jsr_codes:
             address = (bc >> cls.SubAddressShift) & 0x3ff
             # print address
             repeat = bc & ((1 << cls.SubAddressShift) - 1)
@@ -621,6 +694,438 @@ class Program_UnAssembled(object):
 
 Prg_NA = Program_UnAssembled
 
+
+class CompactProgram(object):
+    """
+    Compiled FPGA program stored as a numpy uint32 array of bytecode indexed by address,
+    with a mask of the addresses in use and side tables for subroutine names.
+    Instruction fields are decoded for all addresses at once.
+    """
+
+    def __init__(self, words, used, subroutines=None, jsr_names=None):
+        """
+        :param words: np.array of uint32 bytecode, indexed by address
+        :param used: np.array of bool, addresses holding an instruction
+        :param subroutines: dict of subroutine/main start addresses by name
+        :param jsr_names: dict of subroutine names called by JSR instructions, by address
+        :return:
+        """
+        self.words = np.asarray(words, dtype=np.uint32)
+        self.used = np.asarray(used, dtype=bool)
+        if self.words.shape != self.used.shape:
+            raise ValueError('Mismatched bytecode and mask sizes')
+        self.subroutines = dict(subroutines or {})
+        self.jsr_names = dict(jsr_names or {})
+
+    def __len__(self):
+        return int(np.count_nonzero(self.used))
+
+    @classmethod
+    def encode(cls, opcodes, function_ids, infinite_loops, repeats, addresses):
+        """
+        Bytecode of instructions given field by field (as in Instruction.bytecode()).
+        :return: np.array of uint32
+        """
+        opcodes = np.asarray(opcodes, dtype=np.uint32)
+        function_ids = np.asarray(function_ids, dtype=np.uint32)
+        infinite_loops = np.asarray(infinite_loops, dtype=bool)
+        repeats = np.asarray(repeats, dtype=np.uint32)
+        addresses = np.asarray(addresses, dtype=np.uint32)
+
+        call = np.isin(opcodes, Instruction.Call_codes)
+        jsr = np.isin(opcodes, Instruction.Jsr_codes)
+        shift = Instruction.SubAddressShift
+
+        words = (opcodes & 0xf) << 28
+        callwords = ((function_ids & 0xf) << 24) | np.where(infinite_loops, np.uint32(1 << 23), repeats & 0x3fffff)
+        jsrwords = ((addresses & 0x3ff) << shift) | (repeats & ((1 << shift) - 1))
+        words |= np.where(call, callwords, np.where(jsr, jsrwords, 0)).astype(np.uint32)
+
+        return words
+
+    @classmethod
+    def from_program(cls, program):
+        """
+        Compact version of a Program.
+        :param program: Program
+        :return: CompactProgram
+        """
+        instrs = program.instructions
+        addrs = np.array(sorted(instrs.keys()), dtype=np.int64)
+        size = int(addrs[-1]) + 1 if len(addrs) else 0
+
+        fields = np.zeros((5, len(addrs)), dtype=np.uint32)
+        jsr_names = {}
+        for i, addr in enumerate(addrs.tolist()):
+            instr = instrs[addr]
+            if instr.opcode in instr.Jsr_codes:
+                if instr.address is None:
+                    raise ValueError("Unassembled JSR instruction. No bytecode")
+                if instr.subroutine is not None:
+                    jsr_names[addr] = instr.subroutine
+                fields[4, i] = instr.address
+            elif instr.opcode not in instr.Call_codes and \
+                    instr.opcode not in [instr.OP_ReturnFromSubroutine, instr.OP_EndOfProgram]:
+                raise ValueError("Invalid instruction")
+            fields[0, i] = instr.opcode
+            fields[1, i] = instr.function_id
+            fields[2, i] = instr.infinite_loop
+            fields[3, i] = instr.repeat
+
+        words = np.zeros(size, dtype=np.uint32)
+        used = np.zeros(size, dtype=bool)
+        words[addrs] = cls.encode(fields[0], fields[1], fields[2], fields[3], fields[4])
+        used[addrs] = True
+
+        return cls(words, used, program.subroutines, jsr_names)
+
+    def addresses(self):
+        """
+        Addresses holding an instruction.
+        :return: np.array
+        """
+        return np.flatnonzero(self.used)
+
+    def opcodes(self):
+        return self.words >> 28
+
+    def is_call(self):
+        return np.isin(self.opcodes(), Instruction.Call_codes)
+
+    def is_jsr(self):
+        return np.isin(self.opcodes(), Instruction.Jsr_codes)
+
+    def function_ids(self):
+        return np.where(self.is_call(), (self.words >> 24) & 0xf, 0)
+
+    def infinite_loops(self):
+        return self.is_call() & ((self.words & (1 << 23)) != 0)
+
+    def repeats(self):
+        return np.where(self.is_call(), self.words & 0x3fffff,
+                        np.where(self.is_jsr(), self.words & ((1 << Instruction.SubAddressShift) - 1), 0))
+
+    def jsr_addresses(self):
+        return np.where(self.is_jsr(), (self.words >> Instruction.SubAddressShift) & 0x3ff, 0)
+
+    def bytecode(self, program_base_addr=0x0):
+        """
+        Bytecode of the program with memory addresses, in a single array operation.
+        :param program_base_addr:
+        :return: tuple of np.arrays (addresses, bytecode)
+        """
+        addrs = self.addresses()
+
+        return addrs | program_base_addr, self.words[addrs]
+
+    def instruction(self, address):
+        """
+        Rebuilds the Instruction at a given address.
+        :param address:
+        :return: Instruction
+        """
+        if address < 0 or address >= len(self.used) or not self.used[address]:
+            raise ValueError('No instruction at address 0x%03x' % address)
+
+        bc = int(self.words[address])
+        opcode = bc >> 28
+        if opcode in Instruction.Call_codes:
+            infinite_loop = (bc & (1 << 23)) != 0
+            return Instruction(opcode=opcode,
+                               function_id=(bc >> 24) & 0xf,
+                               infinite_loop=infinite_loop,
+                               repeat=0 if infinite_loop else bc & 0x3fffff)
+        elif opcode in Instruction.Jsr_codes:
+            instr = Instruction(opcode=opcode,
+                                address=(bc >> Instruction.SubAddressShift) & 0x3ff,
+                                repeat=bc & ((1 << Instruction.SubAddressShift) - 1))
+            instr.subroutine = self.jsr_names.get(address)
+            return instr
+
+        return Instruction(opcode=opcode)
+
+    def to_program(self):
+        """
+        Expands back to a Program (dictionary of Instruction objects).
+        :return: Program
+        """
+        program = Program()
+        for addr in self.addresses().tolist():
+            program.instructions[addr] = self.instruction(addr)
+        program.subroutines = dict(self.subroutines)
+
+        return program
+
+class MemoryImage(object):
+    """
+    Complete FPGA memory image of a sequencer, as contiguous numpy uint32 blocks:
+    function outputs (16 slots of 16 slices), slice durations (same layout), program,
+    and pointers (pairs of absolute address and value, as pointers are not contiguous).
+    Block addresses are relative to their base address (as in the compiled files).
+    """
+
+    outputs_base_addr = 0x100000
+    slices_base_addr = 0x200000
+    program_base_addr = 0x300000
+
+    Blocks = ['outputs', 'slices', 'program', 'pointers']
+
+    def __init__(self, outputs, slices, program, pointers):
+        self.outputs = np.asarray(outputs, dtype=np.uint32)
+        self.slices = np.asarray(slices, dtype=np.uint32)
+        self.program = np.asarray(program, dtype=np.uint32)
+        self.pointers = np.asarray(pointers, dtype=np.uint32).reshape((-1, 2))
+
+    def __repr__(self):
+        return "MemoryImage: %d outputs, %d slices, %d program, %d pointers words" % \
+               (len(self.outputs), len(self.slices), len(self.program), len(self.pointers))
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryImage) and \
+            all([np.array_equal(getattr(self, b), getattr(other, b)) for b in self.Blocks])
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def block_bases(self):
+        return {'outputs': self.outputs_base_addr,
+                'slices': self.slices_base_addr,
+                'program': self.program_base_addr}
+
+    def writes(self):
+        """
+        All (address, value) memory writes of the image, for bulk loading.
+        :return: tuple of np.arrays (addresses, values)
+        """
+        addrs = [np.arange(len(getattr(self, b)), dtype=np.uint32) | base
+                 for b, base in sorted(self.block_bases().items())]
+        words = [getattr(self, b) for b, base in sorted(self.block_bases().items())]
+        addrs.append(self.pointers[:, 0])
+        words.append(self.pointers[:, 1])
+
+        return np.concatenate(addrs), np.concatenate(words)
+
+    def save_npz(self, filename):
+        """
+        Saves all blocks to a numpy .npz file.
+        :param filename:
+        :return:
+        """
+        np.savez(filename, **dict([(b, getattr(self, b)) for b in self.Blocks]))
+
+    @classmethod
+    def load_npz(cls, filename):
+        """
+        Reads back an image saved by save_npz().
+        :param filename:
+        :return: MemoryImage
+        """
+        data = np.load(filename)
+        return cls(*[data[b] for b in cls.Blocks])
+
+    def save_raw(self, prefix):
+        """
+        Saves each block as raw little-endian 32 bits words, in files <prefix>.<block>.bin.
+        :param prefix:
+        :return: list of file names
+        """
+        filenames = []
+        for b in self.Blocks:
+            filename = '%s.%s.bin' % (prefix, b)
+            getattr(self, b).astype('<u4').tofile(filename)
+            filenames.append(filename)
+
+        return filenames
+
+    @classmethod
+    def load_raw(cls, prefix):
+        """
+        Reads back an image saved by save_raw().
+        :param prefix:
+        :return: MemoryImage
+        """
+        return cls(*[np.fromfile('%s.%s.bin' % (prefix, b), dtype='<u4') for b in cls.Blocks])
+
+
+# # -----------------------------------------------------------------------
+
+
+class ProgramVisitor(object):
+    """
+    Receives the events of Sequencer.walk() through a compiled program.
+    Subclasses override the events they need. Returning ProgramVisitor.Stop from
+    any event ends the walk, returning ProgramVisitor.Skip from enter_subroutine()
+    goes on with the next instruction without walking through the subroutine.
+    """
+    Skip = 'skip'
+    Stop = 'stop'
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        """
+        Call of function #funcnum (pointers resolved), with the given number of repetitions.
+        :param address: instruction address
+        :param instr: Instruction
+        :param level: subroutine nesting level of the instruction
+        """
+        pass
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        """
+        Jump to the subroutine at target_address (pointers resolved), repeated.
+        The instructions of the subroutine follow at level + 1.
+        """
+        pass
+
+    def leave_subroutine(self, address, instr, level):
+        """
+        End of the subroutine (or main) at the given level, on its RTS or END instruction.
+        instr is None if the walk ran out of program memory instead.
+        """
+        pass
+
+
+class ExecVisitor(ProgramVisitor):
+    """
+    Listing of all instructions executed, for Sequencer.recurse_exec().
+    """
+
+    def __init__(self, seq, verbose=True):
+        self.seq = seq
+        self.verbose = verbose
+        self.listexec = []
+
+    def add_line(self, address, level):
+        s = '%s%s' % ('__' * level, self.seq.repr_instruction(address))
+        self.listexec.append(s)
+        if self.verbose:
+            print(s)
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        self.add_line(address, level)
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        self.add_line(address, level)
+
+    def leave_subroutine(self, address, instr, level):
+        if instr is not None:
+            self.add_line(address, level)
+
+
+class TimingVisitor(ProgramVisitor):
+    """
+    Duration of a subroutine, for Sequencer.recurse_time().
+    Durations of subroutines are stored in (and, if not verbose, read from) the sequencer time cache.
+    """
+
+    def __init__(self, seq, start_address, clockperiod, verbose=True):
+        self.seq = seq
+        self.clockperiod = clockperiod
+        self.verbose = verbose
+        # one frame per subroutine level: [running total, key in time cache, JSR instruction, repetitions]
+        self.frames = [[0, (start_address, clockperiod), None, 1]]
+        self.total_time = None
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        frame = self.frames[-1]
+        instr_time = self.seq.functions[funcnum].total_time() * repetitions * self.clockperiod
+        frame[0] += instr_time
+        if self.verbose:
+            print('%s%s  run time: %.2f us  run total: %.2f us' %
+                  ('__' * level, instr.__repr__(), instr_time, frame[0]))
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        key = (target_address, self.clockperiod)
+        if not self.verbose and key in self.seq.time_cache:
+            self.frames[-1][0] += self.seq.time_cache[key] * repetitions
+            return self.Skip
+        self.frames.append([0, key, instr, repetitions])
+
+    def leave_subroutine(self, address, instr, level):
+        subtime, key, jsr, repetitions = self.frames.pop()
+        if self.verbose and instr is not None:
+            print('%s%s  run total: %.2f us' % ('__' * level, instr.__repr__(), subtime))
+        self.seq.time_cache[key] = subtime
+
+        if not self.frames:
+            self.total_time = subtime
+            return
+
+        # back in the calling subroutine
+        frame = self.frames[-1]
+        instr_time = subtime * repetitions
+        frame[0] += instr_time
+        if self.verbose:
+            print('%s%s  run time: %.2f us  run total: %.2f us' %
+                  ('__' * (level - 1), jsr.__repr__(), instr_time, frame[0]))
+
+
+class ListingVisitor(ProgramVisitor):
+    """
+    Unrolled listing of instructions with timing, for Sequencer.recurse_full().
+    Lines of JSR instructions are completed with their run time when the subroutine returns.
+    """
+
+    def __init__(self, seq, clockperiod, verbose=True):
+        self.seq = seq
+        self.clockperiod = clockperiod
+        self.verbose = verbose
+        self.listexec = []
+        # one frame per subroutine level: [running total, index of JSR line, JSR line, repetitions]
+        self.frames = [[0, None, '', 1]]
+        self.total_time = None
+
+    def add_line(self, s, index=None):
+        if index is None:
+            self.listexec.append(s)
+        else:
+            self.listexec[index] = s
+        if self.verbose:
+            print(s)
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        s = '%s%s' % ('__' * level, self.seq.repr_instruction(address))
+        instr_time = self.seq.functions[funcnum].total_time() * repetitions * self.clockperiod
+        s += ' = run time: %.2f us  ' % instr_time
+        self.add_line(s)
+        self.frames[-1][0] += instr_time
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        s = '%s%s' % ('__' * level, self.seq.repr_instruction(address))
+        # placeholder until the subroutine time is known
+        self.listexec.append(None)
+        self.frames.append([0, len(self.listexec) - 1, s, repetitions])
+
+    def leave_subroutine(self, address, instr, level):
+        subtime, index, s, repetitions = self.frames.pop()
+        if instr is not None:
+            self.add_line('%s%s = subtotal: %.2f us' % ('__' * level, self.seq.repr_instruction(address), subtime))
+
+        if not self.frames:
+            self.total_time = subtime
+            return
+
+        instr_time = subtime * repetitions
+        self.add_line(s + ' = run time: %.2f us  ' % instr_time, index)
+        self.frames[-1][0] += instr_time
+
+
+class ClockSearchVisitor(ProgramVisitor):
+    """
+    Finds the first function executed with the given clock on, for Sequencer.find_function_withclock().
+    """
+
+    def __init__(self, seq, clockname):
+        self.seq = seq
+        self.clockname = clockname
+        self.found = ''
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        func = self.seq.functions[funcnum]
+        if func.is_on_anytime(self.clockname):
+            self.found = func.name
+            return self.Stop
+
+
 # # -----------------------------------------------------------------------
 
 
@@ -715,7 +1220,40 @@ class Sequencer(object):
         self.functions_desc = functions_desc
         self.program = program  # empty program
         self.parameters = parameters  # memory of the parameter values set in XML/txt
-        self.pointers = pointers  # memory of pointers set in txt
+        self.pointers = pointers  # memory of pointers set in txt (indexed, see PointerTable)
+        self.time_cache = {}  # subroutine durations, see recurse_time()
+        self.time_cache_signature = None
+        self.string_cache = {}  # string tables, see get_sequencer_string()
+        self.string_cache_signature = None
+
+    @property
+    def pointers(self):
+        return self._pointers
+
+    @pointers.setter
+    def pointers(self, pointers):
+        if not isinstance(pointers, PointerTable):
+            pointers = PointerTable(pointers)
+        self._pointers = pointers
+
+    def memory_image(self):
+        """
+        Complete FPGA memory image of the sequencer (functions, program, pointers).
+        Unused function slots and unused program addresses are zero.
+        :return: MemoryImage
+        """
+        durations = np.zeros((16, 16), dtype=np.uint32)
+        outputs = np.zeros((16, 16), dtype=np.uint32)
+        for func_id, func in self.functions.items():
+            durations[func_id], outputs[func_id] = func.bytecode_arrays(func_id)
+
+        pointers = []
+        for pname, p in self.pointers.items():
+            if p.value is None:
+                raise ValueError('Undefined value for pointer %s' % pname)
+            pointers.append((p.address, p.value))
+
+        return MemoryImage(outputs.ravel(), durations.ravel(), self.program.compact().words, pointers)
 
     def get_function(self, funcref):
         # looks up mapping
@@ -726,7 +1264,7 @@ class Sequencer(object):
         else:
             return None
 
-        if not (self.functions.has_key(func_id)):
+        if func_id not in self.functions:
             return None
 
         return self.functions[func_id]
@@ -738,12 +1276,11 @@ class Sequencer(object):
         :param numptr:
         :return:
         """
-        for pname in self.pointers:
-            p = self.pointers[pname]
-            if p.pointer_type == typeptr and p.ptr_num() == numptr:
-                return p.value
+        pname = self.pointers.lookup(typeptr, numptr)
+        if pname is None:
+            return None
 
-        return None
+        return self.pointers[pname].value
 
     def pointer_name(self, typeptr, numptr):
         """
@@ -751,12 +1288,11 @@ class Sequencer(object):
         :param numptr:
         :return:
         """
-        for pname in self.pointers:
-            p = self.pointers[pname]
-            if p.pointer_type == typeptr and p.ptr_num() == numptr:
-                return pname
+        pname = self.pointers.lookup(typeptr, numptr)
+        if pname is None:
+            return ''
 
-        return ''
+        return pname
 
     def repr_pointer(self, typeptr, numptr):
         """
@@ -766,13 +1302,15 @@ class Sequencer(object):
         :return:
         """
         # need to look up name
-        for pname in self.pointers:
-            p = self.pointers[pname]
-            if p.pointer_type == typeptr and p.ptr_num() == numptr:
-                if typeptr in SequencerPointer.Repeat_pointers:
-                    return "%d: %s -> %d" % (numptr, pname, p.value)
-                else:
-                    return "%d: %s -> %s" % (numptr, pname, p.target)
+        pname = self.pointers.lookup(typeptr, numptr)
+        if pname is None:
+            return None
+
+        p = self.pointers[pname]
+        if typeptr in SequencerPointer.Repeat_pointers:
+            return "%d: %s -> %d" % (numptr, pname, p.value)
+        else:
+            return "%d: %s -> %s" % (numptr, pname, p.target)
 
     def get_pointers_kvc(self):
         """
@@ -841,39 +1379,78 @@ class Sequencer(object):
 
         return s
 
-    def recurse_exec(self, start_address, recurse_level=0, verbose=True):
+    def walk(self, start_address, visitor, recurse_level=0):
         """
-        Auxiliary for recursivity in sequence().
-        :param start_adress:
-        :return:
+        Walks through the program from the given address, following jumps to subroutines
+        with an explicit stack (no recursion), and reports each function call and each
+        entry in and return from a subroutine to the visitor (see ProgramVisitor).
+        Pointers are resolved for function numbers, repetitions and subroutine addresses.
+        :param start_address:
+        :param visitor: ProgramVisitor
+        :param recurse_level: nesting level of the starting subroutine
+        :return: True if the visitor stopped the walk
         """
+        instructions = self.program.instructions
+        stack = []  # return addresses
         current_address = start_address
-        listexec = []
-        strlevel = '__' * recurse_level
-
-        while current_address in self.program.instructions:
-            # fill table with all instructions
-            instr = self.program.instructions[current_address]
-            s = '%s%s' % (strlevel, self.repr_instruction(current_address))
-            listexec.append(s)
-            if verbose:
-                print(s)
-
-            if instr.opcode in [instr.OP_ReturnFromSubroutine, instr.OP_EndOfProgram]:
+        level = recurse_level
+
+        while True:
+            instr = instructions.get(current_address)
+
+            if instr is None or instr.opcode in [instr.OP_ReturnFromSubroutine, instr.OP_EndOfProgram]:
                 # we are done with this level
-                break
-            # if it calls another subroutine : looks its address and recurse
-            elif instr.opcode in instr.Jsr_codes:
+                if visitor.leave_subroutine(current_address, instr, level) == visitor.Stop:
+                    return True
+                if not stack:
+                    return False
+                current_address = stack.pop()
+                level -= 1
+
+            elif instr.opcode in instr.Call_codes:
+                # parse repetitions, look up function
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                    funcnum = instr.function_id
+                else:
+                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
+                if visitor.call_function(current_address, instr, funcnum, repetitions, level) == visitor.Stop:
+                    return True
+                current_address += 1
+
+            else:
+                # parse repetitions, look up new address
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
                 if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
                     target_address = instr.address
                 else:
                     target_address = self.pointer_value('PTR_SUBR', instr.address)
-                listexec.extend(self.recurse_exec(target_address, recurse_level=recurse_level+1, verbose=verbose))
+                action = visitor.enter_subroutine(current_address, instr, target_address, repetitions, level)
+                if action == visitor.Stop:
+                    return True
+                if action == visitor.Skip:
+                    current_address += 1
+                else:
+                    stack.append(current_address + 1)
+                    current_address = target_address
+                    level += 1
 
-            # else : function execution : we go to the next instruction
-            current_address += 1
+    def recurse_exec(self, start_address, recurse_level=0, verbose=True):
+        """
+        Auxiliary for sequence(): list of all instructions executed.
+        :param start_adress:
+        :return:
+        """
+        visitor = ExecVisitor(self, verbose=verbose)
+        self.walk(start_address, visitor, recurse_level)
 
-        return listexec
+        return visitor.listexec
 
     def sequence(self, subr, verbose=True):
         """
@@ -897,57 +1474,36 @@ class Sequencer(object):
 
         return listexec
 
+    def check_time_cache(self):
+        """
+        Empties the cache of subroutine durations if the sequencer content has changed
+        (see content_signature()).
+        :return:
+        """
+        signature = self.content_signature()
+        if signature != self.time_cache_signature:
+            self.time_cache = {}
+            self.time_cache_signature = signature
+
     def recurse_time(self, start_address, clockperiod, recurse_level=0, verbose=True):
         """
-        Auxiliary for recursivity in timing().
+        Auxiliary for timing().
+        Durations are cached per start address for the current pointer configuration,
+        so that a subroutine called several times is walked through only once
+        (unless verbose, where the full breakout is printed).
         :param start_adress:
         :return:
         """
-        current_address = start_address
-        total_time = 0
-        strlevel = '__' * recurse_level
-
-        while current_address in self.program.instructions:
-            instr = self.program.instructions[current_address]
-            if instr.opcode in instr.Call_codes:
-                # parse repetitions, look up function
-                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
-                    repetitions = instr.repeat
-                else:
-                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
-                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
-                    funcnum = instr.function_id
-                else:
-                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
-                instr_time = self.functions[funcnum].total_time() * repetitions * clockperiod
-                total_time += instr_time
-
-            elif instr.opcode in instr.Jsr_codes:
-                # parse repetitions, look up new address, iterate
-                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
-                    repetitions = instr.repeat
-                else:
-                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
-                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
-                    target_address = instr.address
-                else:
-                    target_address = self.pointer_value('PTR_SUBR', instr.address)
-                instr_time = self.recurse_time(target_address, clockperiod, recurse_level=recurse_level+1,
-                                               verbose=verbose) * repetitions
-                total_time += instr_time
-
-            else:
-                if verbose:
-                    print('%s%s  run total: %.2f us' % (strlevel, instr.__repr__(), total_time))
-                break
+        if recurse_level == 0:
+            self.check_time_cache()
+        key = (start_address, clockperiod)
+        if not verbose and key in self.time_cache:
+            return self.time_cache[key]
 
-            # print here to get total after breakout for calls to subroutines
-            if verbose:
-                print('%s%s  run time: %.2f us  run total: %.2f us' %
-                      (strlevel, instr.__repr__(), instr_time, total_time))
-            current_address += 1
+        visitor = TimingVisitor(self, start_address, clockperiod, verbose=verbose)
+        self.walk(start_address, visitor, recurse_level)
 
-        return total_time
+        return visitor.total_time
 
     def timing(self, subr, verbose=True):
         """
@@ -969,73 +1525,14 @@ class Sequencer(object):
 
     def recurse_full(self, start_address, clockperiod, recurse_level=0, verbose=True):
         """
-        Auxiliary for recursivity on sequence breakout and timing.
+        Auxiliary for sequence breakout and timing.
         :param start_adress:
         :return:
         """
-        current_address = start_address
-        listexec = []
-        total_time = 0
-        strlevel = '__' * recurse_level
+        visitor = ListingVisitor(self, clockperiod, verbose=verbose)
+        self.walk(start_address, visitor, recurse_level)
 
-        while current_address in self.program.instructions:
-            instr = self.program.instructions[current_address]
-            s = '%s%s' % (strlevel, self.repr_instruction(current_address))
-
-            if instr.opcode in [instr.OP_ReturnFromSubroutine, instr.OP_EndOfProgram]:
-                # we are done with this level
-                s += (' = subtotal: %.2f us' %  total_time)
-                listexec.append(s)
-                if verbose:
-                    print(s)
-                break
-
-            if instr.opcode in instr.Call_codes:
-                # parse repetitions, look up function
-                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
-                    repetitions = instr.repeat
-                else:
-                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
-                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
-                    funcnum = instr.function_id
-                else:
-                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
-                instr_time = self.functions[funcnum].total_time() * repetitions * clockperiod
-                s += ' = run time: %.2f us  ' % instr_time
-                # append to table collecting all instructions
-                listexec.append(s)
-                if verbose:
-                    print(s)
-
-            elif instr.opcode in instr.Jsr_codes:
-                # parse repetitions, look up new address, recurse
-                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
-                    repetitions = instr.repeat
-                else:
-                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
-                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
-                    target_address = instr.address
-                else:
-                    target_address = self.pointer_value('PTR_SUBR', instr.address)
-                subexec, subtime = self.recurse_full(target_address, clockperiod, recurse_level=recurse_level+1,
-                                               verbose=verbose)
-                instr_time =  subtime * repetitions
-                s += ' = run time: %.2f us  ' % instr_time
-                # heads list with subroutine call
-                listexec.append(s)
-                if verbose:
-                    print(s)
-                # appends called subroutine to execution list
-                listexec.extend(subexec)
-
-            else:
-                raise ValueError('Unknown opcode %s' % instr.opcode)
-
-            total_time += instr_time
-
-            current_address += 1
-
-        return listexec, total_time
+        return visitor.listexec, visitor.total_time
 
     def find_function_withclock(self, subr, clockname):
         """
@@ -1051,67 +1548,71 @@ class Sequencer(object):
             print('Unknown subroutine name: %s' % subr)
             return ''
 
-        current_address = self.program.subroutines[subr]
-        saved_address = []
+        visitor = ClockSearchVisitor(self, clockname)
+        self.walk(self.program.subroutines[subr], visitor)
 
-        while current_address in self.program.instructions:
-            instr = self.program.instructions[current_address]
-            if instr.opcode in instr.Call_codes:
-                # function
-                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
-                    funcnum = instr.function_id
-                else:
-                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
-                if self.functions[funcnum].is_on_anytime(clockname):
-                    return self.functions[funcnum].name
-                # moves on to next instruction
-                current_address += 1
+        return visitor.found
 
-            elif instr.opcode in instr.Jsr_codes:
-                # stacks memory of where the next instruction would be
-                saved_address.append(current_address + 1)
-                # looks up call to subroutine and goes there
-                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
-                    current_address = instr.address
-                else:
-                    current_address = self.pointer_value('PTR_SUBR', instr.address)
-            else:
-                if not saved_address:
-                    # reached end of program without finding clock
-                    return ''
-                # returns from end of subroutine
-                current_address = saved_address.pop()
+    def content_signature(self):
+        """
+        Summary of the whole sequencer content (functions, program, pointers),
+        used to detect changes invalidating cached representations.
+        :return: tuple
+        """
+        funcs = tuple([(funcnum, f.name, f.fullname,
+                        tuple(sorted(f.timelengths.items())), tuple(sorted(f.outputs.items())))
+                       for funcnum, f in self.functions.items()])
+        prog = tuple([(addr, instr.opcode, instr.function_id, instr.infinite_loop, instr.repeat,
+                       instr.address, instr.subroutine)
+                      for addr, instr in sorted(self.program.instructions.items())])
+        ptrs = tuple([(pname, p.pointer_type, p.address, p.value, p.target) for pname, p in self.pointers.items()])
 
-        return ''
+        return funcs, prog, tuple(sorted(self.program.subroutines.items())), ptrs
 
     def get_sequencer_string(self, subr=''):
         """
         Builds a string table representation of the sequencer content (for insertion in FITS table extension).
-        If a subroutine name is given, rebuilds the actual sequence executed.
-        :return: np.array
+        If a subroutine name is given, rebuilds the actual sequence executed
+        (instructions only, without the run times printed by sequence()).
+        Tables are cached per subroutine until the sequencer content changes.
+        :return: np.array of fixed-width bytes, dtype S<width> (one line per item),
+        where earlier versions returned unicode strings
         """
-        reprarray = np.zeros(shape=(0,), dtype=np.dtype('l', 'S73'))
+        signature = self.content_signature()
+        if signature != self.string_cache_signature:
+            self.string_cache = {}
+            self.string_cache_signature = signature
+
+        if subr not in self.string_cache:
+            lines = []
+
+            # all functions
+            for ifunc in self.functions:
+                reprfunc = self.functions[ifunc].__repr__()
+                for l in reprfunc.splitlines():
+                    if l:
+                        lines.append(l.expandtabs(8))
+
+            if subr in self.program.subroutines:
+                # execution only, no timing
+                reprprog = self.recurse_exec(self.program.subroutines[subr], verbose=False)
+            elif subr:
+                print('Unknown subroutine name: %s' % subr)
+                reprprog = []
+            else:
+                # splitting the subroutine stack into array lines
+                reprprog = self.program.__repr__().splitlines()
+            lines.extend(reprprog)
 
-        # all functions
-        for ifunc in self.functions:
-            reprfunc = self.functions[ifunc].__repr__()
-            for l in reprfunc.splitlines():
-                if l:
-                    reprarray = np.append(reprarray, l.expandtabs(8))
+            # adding the pointer values if any
+            for p in self.pointers:
+                lines.append(self.pointers[p].__repr__())
 
-        if subr:
-            reprprog = self.sequence(subr, verbose=False)
-        else:
-            # splitting the subroutine stack into array lines
-            reprprog = self.program.__repr__().splitlines()
-        for l in reprprog:
-            reprarray = np.append(reprarray, l)
+            width = max([len(l) for l in lines] + [1])
+            self.string_cache[subr] = np.array([l.encode('ascii', 'replace') for l in lines],
+                                               dtype='S%d' % width)
 
-        # adding the pointer values if any
-        for p in self.pointers:
-            reprarray = np.append(reprarray, self.pointers[p].__repr__())
-
-        return reprarray
+        return self.string_cache[subr].copy()
 
 
 ## -----------------------------------------------------------------------
@@ -1325,59 +1826,96 @@ class Function(object):
         """
         return sum([self.timelengths[t] for t in self.timelengths])+3
 
-    def scope(self, channel):
+    def slice_durations(self):
         """
-        Returns a list with on/off values for the given channel, with one item per FPGA cycle.
-        :return:
+        Returns the time slices and their durations in clock cycles, including
+        the additional cycles at beginning and end of function.
+        :return: list, np.array
         """
-        ntime = self.total_time()
-        timescope = [0] * ntime
-        i = 0
+        tslices = sorted(self.timelengths.keys())
+        durations = np.array([self.timelengths[t] for t in tslices], dtype=np.int64)
 
-        for tslice in sorted(self.timelengths.keys()):
-            duration = self.timelengths[tslice]
+        for i, tslice in enumerate(tslices):
             # special cases at beginning and end of function
             if tslice == 0:
-                duration += 1
+                durations[i] += 1
             if tslice+1 not in self.timelengths:
-                duration += 2
+                durations[i] += 2
+
+        return tslices, durations
+
+    def slice_states(self, channels=None):
+        """
+        Returns the states (0/1) of the given channels during each time slice.
+        :param channels: list of channels (names or numbers), all 32 outputs if None
+        :return: np.array of shape (nchannels, nslices)
+        """
+        if channels is None:
+            channels = range(32)
+        bits = np.array([self.channels[c] if isinstance(c, str) else c for c in channels], dtype=np.uint32)
 
-            if self.is_on(channel, tslice):
-                for d in range(duration):
-                    timescope[i+d] = 1
-            i += duration
+        tslices = sorted(self.timelengths.keys())
+        outputs = np.array([self.outputs[t] & 0xffffffff for t in tslices], dtype=np.uint32)
 
-        return timescope
+        return ((outputs[np.newaxis, :] >> bits[:, np.newaxis]) & 1).astype(np.uint8)
 
-    def bytecode(self, function_id, slices_base_addr=0x200000, outputs_base_addr=0x100000):
+    def scope_array(self, channels=None, packed=False):
         """
-        Compute the function bytecode to be sent to the FPGA memory
-        at the function #function_dd slot.
-        Be careful: addresses are relative
+        Returns the states of all (or the given) channels with one column per FPGA cycle.
+        :param channels: list of channels (names or numbers), all 32 outputs if None
+        :param packed: if True, returns instead the 32 bits output word for each cycle
+        :return: np.array, uint8 of shape (nchannels, ncycles) or uint32 of shape (ncycles,) if packed
+        """
+        tslices, durations = self.slice_durations()
+
+        if packed:
+            outputs = np.array([self.outputs[t] & 0xffffffff for t in tslices], dtype=np.uint32)
+            return np.repeat(outputs, durations)
+
+        return np.repeat(self.slice_states(channels), durations, axis=1)
+
+    def scope(self, channel):
+        """
+        Returns a list with on/off values for the given channel, with one item per FPGA cycle.
+        :return:
+        """
+        return self.scope_array([channel])[0].tolist()
+
+    def bytecode_arrays(self, function_id):
+        """
+        Slice durations and outputs of the function, as stored in the 16 slots of the
+        function #function_id in the FPGA memory.
+        Function #0 is a special case: only the first slice has meaning.
+        :param function_id:
+        :return: tuple of two np.arrays of 16 uint32 (durations, outputs)
         """
         if function_id not in range(16):
             raise ValueError("Invalid Function ID")
 
-        slices_addr = slices_base_addr | (function_id << 4)
-        outputs_addr = outputs_base_addr | (function_id << 4)
+        durations = np.zeros(16, dtype=np.uint32)
+        outputs = np.zeros(16, dtype=np.uint32)
 
-        bcodes = {}
+        tslices = np.array([t for t in self.timelengths if t in range(16)], dtype=np.int64)
+        durations[tslices] = np.array([self.timelengths[t] & 0xffff for t in tslices.tolist()], dtype=np.uint32)
+        tslices = np.array([t for t in self.outputs if t in range(16)], dtype=np.int64)
+        outputs[tslices] = np.array([self.outputs[t] & 0xffffffff for t in tslices.tolist()], dtype=np.uint32)
 
-        # Set the given function slices and outputs
-        # function #0 -> special case, only the first slice has meaning
+        if function_id == 0:
+            durations[1:] = 0
+            outputs[1:] = 0
 
-        for sl in range(16):
-            slice_addr = slices_addr | sl
-            duration = self.timelengths.get(sl, 0) & 0xffff
-            if (function_id == 0) and (sl > 0):
-                duration = 0
-            bcodes[slice_addr] = duration
-
-            output_addr = outputs_addr | sl
-            output = self.outputs.get(sl, 0) & 0xffffffff
-            if (function_id == 0) and (sl > 0):
-                output = 0
-            bcodes[output_addr] = output
+        return durations, outputs
 
-        return bcodes
+    def bytecode(self, function_id, slices_base_addr=0x200000, outputs_base_addr=0x100000):
+        """
+        Compute the function bytecode to be sent to the FPGA memory
+        at the function #function_dd slot.
+        Be careful: addresses are relative
+        """
+        durations, outputs = self.bytecode_arrays(function_id)
 
+        slots = np.arange(16) | (function_id << 4)
+        bcodes = dict(zip((slots | slices_base_addr).tolist(), durations.tolist()))
+        bcodes.update(zip((slots | outputs_base_addr).tolist(), outputs.tolist()))
+
+        return bcodes
@@ -5,19 +5,33 @@
 # Changelog
 # 20161206: C. Juramy, initialized from LPNHE bench code.
 #
+# 20261018: batch mode, durations of all mains, subroutines and functions of many files.
+#
 # Syntax as main:
 # python timing.py [sequencer-file.seq] [Main or Subroutine]
+# python timing.py [--csv|--json] [-j nprocs] [-c] [dir|glob] <[dir|glob] ...>
 # Example:
 # python timing.py seq-newflush.txt Acquisition
+# python timing.py --csv ../run5 > run5-timing.csv
 #
 # Syntax in a script:
 # import timing
 # timing.breakout("seq-newflush.txt", "Acquisition")
-
+# rows = timing.batch_timing([".."])
+from __future__ import print_function
 import sys
+import csv
+import json
+import optparse
 
 # add sequencer reading method
 import rebtxt
+import grammar
+import seqcompiler
+import timingmodel
+
+# columns of the batch timing table
+batch_columns = ['file', 'type', 'name', 'cycles', 'duration_us', 'error']
 
 
 def breakout(seqfile, exptype):
@@ -46,11 +60,142 @@ def function_time(seqfile, funcname):
     return func.total_time()
 
 
+def subroutine_type(seq, subr):
+    """
+    'main' if the given main/subroutine ends with END, 'subroutine' otherwise.
+    """
+    address = seq.program.subroutines[subr]
+    while address in seq.program.instructions:
+        instr = seq.program.instructions[address]
+        if instr.opcode == instr.OP_EndOfProgram:
+            return 'main'
+        if instr.opcode == instr.OP_ReturnFromSubroutine:
+            break
+        address += 1
+
+    return 'subroutine'
+
+
+def file_timings(seqfile, cachedir=None):
+    """
+    Durations of all mains, subroutines and functions of a sequencer file, in a single parse.
+    Rows are dictionaries with the batch_columns keys (cycles and duration None if not computable).
+    :param seqfile:
+    :param cachedir: parse cache directory (see grammar.parse_file_cached)
+    :return: list of dict
+    """
+    try:
+        seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False, cachedir=cachedir)
+        if seq is None:
+            raise ValueError('Parsing failed')
+    except Exception as e:
+        return [dict(zip(batch_columns, [seqfile, 'file', '', None, None, '%s: %s' % (type(e).__name__, e)]))]
+
+    clockperiod = seq.parameters.get('clockperiod')
+    model = timingmodel.TimingModel(seq)
+
+    rows = []
+    entries = [(subroutine_type(seq, name), name) for name in sorted(seq.program.subroutines)]
+    entries += [('function', func.name) for func_id, func in sorted(seq.functions.items())]
+    for kind, name in entries:
+        cycles = None
+        error = ''
+        try:
+            if kind == 'function':
+                cycles = seq.get_function(name).total_time()
+            else:
+                cycles = int(model.cycles(name))
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+
+        if cycles is not None and clockperiod is not None:
+            duration = cycles * clockperiod * 1e6
+        else:
+            duration = None
+        rows.append(dict(zip(batch_columns, [seqfile, kind, name, cycles, duration, error])))
+
+    return rows
+
+
+def timing_task(task):
+    """
+    Timings of a single file for batch_timing() (runs in a worker process).
+    """
+    seqfile, cachedir = task
+
+    return file_timings(seqfile, cachedir)
+
+
+def batch_timing(patterns, nprocs=None, cachedir=None):
+    """
+    Durations of all mains, subroutines and functions of all sequencer files given as
+    directories or glob patterns, files being processed in parallel.
+    :param patterns: list of directories or glob patterns
+    :param nprocs: number of processes (default: number of CPUs)
+    :param cachedir: parse cache directory
+    :return: list of dict (see file_timings)
+    """
+    seqfiles = seqcompiler.find_seqfiles(patterns)
+    if not seqfiles:
+        return []
+
+    results = seqcompiler.batch_map(timing_task, [(seqfile, cachedir) for seqfile in seqfiles], nprocs)
+
+    return [row for rows in results for row in rows]
+
+
+def write_csv(rows, out=sys.stdout):
+    writer = csv.DictWriter(out, fieldnames=batch_columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_json(rows, out=sys.stdout):
+    json.dump(rows, out, indent=1)
+    print(file=out)
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    parser = optparse.OptionParser(usage = \
+    """
+    %prog <sequencer-file> <main|subroutine|function>
+    %prog --csv|--json [-j <nprocs>] [-c] <dir|glob> [<dir|glob> ...]
+
+    Prints the breakdown of a main, subroutine or function, or the table of
+    durations of all mains, subroutines and functions of many files.
+    """)
+    parser.add_option('--csv', default=False, action='store_true',
+                      help='Batch mode, table in CSV format')
+    parser.add_option('--json', default=False, action='store_true',
+                      help='Batch mode, table in JSON format')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Number of processes in batch mode (default: number of CPUs)')
+    parser.add_option('-c', '--cache', default=False, action='store_true',
+                      help='Reuse parse results cached in %s' % grammar.default_cachedir)
+
+    (options, args) = parser.parse_args()
+
+    if options.cache:
+        cachedir = grammar.default_cachedir
+    else:
+        cachedir = None
+
+    if options.csv or options.json:
+        if not args:
+            parser.print_help()
+            sys.exit(1)
+        rows = batch_timing(args, nprocs=options.jobs, cachedir=cachedir)
+        if options.csv:
+            write_csv(rows)
+        else:
+            write_json(rows)
+        sys.exit()
+
+    if len(args) < 2:
         print("timing.py requires sequencer file and main/subroutine/function name")
         sys.exit()
-    seqfile = sys.argv[1]
-    exptype = sys.argv[2]
+    seqfile = args[0]
+    exptype = args[1]
 
     breakout(seqfile, exptype)
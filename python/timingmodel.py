@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+#
+# LSST
+# Closed-form timing model of the sequencer mains and subroutines.
+#
+# The duration of a main is a polynomial in its repeat pointers (REP_FUNC, REP_SUBR),
+# with coefficients in clock cycles: the program is walked through once, and the
+# duration for any assignment of the repeat pointers is then a single evaluation.
+# Execution pointers (PTR_FUNC, PTR_SUBR) change the structure of the program:
+# the model is only valid for the targets they had when it was built.
+#
+# Syntax as main:
+# python timingmodel.py [sequencer-file.seq] <[Main or Subroutine]>
+# Example:
+# python timingmodel.py seq-newflush.txt Acquisition
+#
+# Syntax in a script:
+# import rebtxt, timingmodel
+# seq = rebtxt.Sequencer.fromtxtfile("seq-newflush.txt", verbose=False)
+# model = timingmodel.TimingModel(seq)
+# model.polynomial("Acquisition")                      # in clock cycles
+# model.timing("Acquisition", {'ReadRows': 1000})      # in microseconds
+# model.timing("Acquisition", {'ReadRows': np.arange(2000)})   # sweep, as np.array
+from __future__ import print_function
+import sys
+
+from sequencer import ProgramVisitor, SequencerPointer
+
+
+class Polynomial(object):
+    """
+    Polynomial in named variables with integer coefficients.
+    Terms are stored as {monomial: coefficient}, a monomial being the sorted tuple
+    of its variable names (repeated for powers), () for the constant term.
+    """
+
+    def __init__(self, terms=None):
+        self.terms = {}
+        if terms:
+            for monomial, coeff in terms.items():
+                self.add_term(monomial, coeff)
+
+    def __repr__(self):
+        if not self.terms:
+            return "0"
+
+        items = []
+        for monomial in sorted(self.terms, key=lambda m: (len(m), m)):
+            factors = []
+            for var in sorted(set(monomial)):
+                power = monomial.count(var)
+                if power > 1:
+                    factors.append("%s^%d" % (var, power))
+                else:
+                    factors.append(var)
+            coeff = self.terms[monomial]
+            if not factors:
+                items.append("%d" % coeff)
+            elif coeff == 1:
+                items.append("*".join(factors))
+            else:
+                items.append("%d*%s" % (coeff, "*".join(factors)))
+
+        return " + ".join(items)
+
+    def __eq__(self, other):
+        return isinstance(other, Polynomial) and self.terms == other.terms
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def add_term(self, monomial, coeff):
+        monomial = tuple(sorted(monomial))
+        coeff = self.terms.get(monomial, 0) + coeff
+        if coeff:
+            self.terms[monomial] = coeff
+        else:
+            self.terms.pop(monomial, None)
+
+    def add(self, other, factor=1, variable=None):
+        """
+        Adds other * factor (* variable if given) to this polynomial, in place.
+        :param other: Polynomial
+        :param factor: int
+        :param variable: variable name or None
+        :return:
+        """
+        if not factor:
+            return
+        for monomial, coeff in other.terms.items():
+            if variable is not None:
+                monomial = monomial + (variable,)
+            self.add_term(monomial, coeff * factor)
+
+    def variables(self):
+        """
+        Names of the variables appearing in the polynomial, sorted.
+        """
+        names = set()
+        for monomial in self.terms:
+            names.update(monomial)
+
+        return sorted(names)
+
+    def degree(self):
+        return max([len(m) for m in self.terms] + [0])
+
+    def evaluate(self, values):
+        """
+        Value of the polynomial. Values may be numbers or np.arrays (evaluated elementwise,
+        with the usual broadcasting rules).
+        :param values: dict of variable values
+        :return:
+        """
+        total = 0
+        for monomial, coeff in self.terms.items():
+            term = coeff
+            for var in monomial:
+                if var not in values:
+                    raise ValueError('No value given for variable %s' % var)
+                term = term * values[var]
+            total = total + term
+
+        return total
+
+
+class PolynomialTimingVisitor(ProgramVisitor):
+    """
+    Builds the timing polynomials of subroutines, for TimingModel.
+    Polynomials of subroutines are built once per target address and shared by all their calls.
+    Functions called in an infinite loop add nothing to the polynomial: the start addresses
+    of the subroutines reaching an infinite loop are collected instead.
+    """
+
+    def __init__(self, seq, polynomials, infinite):
+        self.seq = seq
+        self.polynomials = polynomials  # by start address
+        self.infinite = infinite  # set of start addresses
+        # one frame per subroutine level: [polynomial, start address, JSR instruction, infinite loop reached]
+        self.frames = []
+
+    def start(self, start_address):
+        self.frames = [[Polynomial(), start_address, None, False]]
+
+    def repeat_variable(self, instr, typeptr):
+        """
+        Name of the repeat pointer used by the instruction, None if the repetition is a constant.
+        """
+        if instr.opcode not in [instr.OP_CallFuncPointerRepeat, instr.OP_CallPointerFuncPointerRepeat,
+                                instr.OP_JumpSubPointerRepeat, instr.OP_JumpPointerSubPointerRepeat]:
+            return None
+
+        pname = self.seq.pointer_name(typeptr, instr.repeat)
+        if not pname:
+            raise ValueError('Undefined %s pointer #%d' % (typeptr, instr.repeat))
+
+        return pname
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        if instr.infinite_loop:
+            self.frames[-1][3] = True
+            return
+        funcpoly = Polynomial({(): self.seq.functions[funcnum].total_time()})
+        variable = self.repeat_variable(instr, 'REP_FUNC')
+        if variable is None:
+            self.frames[-1][0].add(funcpoly, instr.repeat)
+        else:
+            self.frames[-1][0].add(funcpoly, 1, variable)
+
+    def add_subroutine(self, instr, subpoly):
+        variable = self.repeat_variable(instr, 'REP_SUBR')
+        if variable is None:
+            self.frames[-1][0].add(subpoly, instr.repeat)
+        else:
+            self.frames[-1][0].add(subpoly, 1, variable)
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        if target_address in self.polynomials:
+            self.add_subroutine(instr, self.polynomials[target_address])
+            if target_address in self.infinite:
+                self.frames[-1][3] = True
+            return self.Skip
+        self.frames.append([Polynomial(), target_address, instr, False])
+
+    def leave_subroutine(self, address, instr, level):
+        subpoly, start_address, jsr, infinite = self.frames.pop()
+        self.polynomials[start_address] = subpoly
+        if infinite:
+            self.infinite.add(start_address)
+        if self.frames:
+            self.add_subroutine(jsr, subpoly)
+            if infinite:
+                self.frames[-1][3] = True
+
+
+class TimingModel(object):
+    """
+    Timing polynomials (in clock cycles) of the mains and subroutines of a sequencer,
+    in its repeat pointers. Built for the current execution pointers of the sequencer;
+    the current repeat pointer values are used for the pointers not given at evaluation.
+    Durations of mains and subroutines reaching an infinite loop are refused (ValueError),
+    their polynomials only hold what precedes or follows the loop.
+    """
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.polynomials = {}  # by start address
+        self.infinite = set()  # start addresses of subroutines reaching an infinite loop
+        self.defaults = {}
+        self.exec_targets = {}
+        for pname, p in seq.pointers.items():
+            if p.pointer_type in SequencerPointer.Repeat_pointers:
+                self.defaults[pname] = p.value
+            else:
+                self.exec_targets[pname] = p.value
+        self.visitor = PolynomialTimingVisitor(seq, self.polynomials, self.infinite)
+
+    def polynomial(self, subr):
+        """
+        Timing polynomial of a main or subroutine, in clock cycles.
+        :param subr: name of main or subroutine
+        :return: Polynomial
+        """
+        if subr not in self.seq.program.subroutines:
+            raise ValueError('Unknown subroutine name: %s' % subr)
+
+        start_address = self.seq.program.subroutines[subr]
+        if start_address not in self.polynomials:
+            self.visitor.start(start_address)
+            self.seq.walk(start_address, self.visitor)
+
+        return self.polynomials[start_address]
+
+    def is_infinite(self, subr):
+        """
+        True if the main or subroutine reaches an infinite loop.
+        """
+        self.polynomial(subr)
+
+        return self.seq.program.subroutines[subr] in self.infinite
+
+    def check_values(self, values):
+        """
+        Merges the given pointer values with the defaults, refusing execution pointers.
+        """
+        allvalues = dict(self.defaults)
+        for pname in values:
+            if pname in self.exec_targets:
+                raise ValueError('Pointer %s is not a repeat pointer: rebuild the model instead' % pname)
+            if pname not in self.defaults:
+                raise ValueError('Unknown pointer name: %s' % pname)
+        allvalues.update(values)
+
+        return allvalues
+
+    def cycles(self, subr, values=None):
+        """
+        Duration of a main or subroutine in clock cycles, for the given repeat pointer values.
+        :param subr: name of main or subroutine
+        :param values: dict of pointer values (numbers or np.arrays)
+        :return:
+        """
+        if self.is_infinite(subr):
+            raise ValueError('%s reaches an infinite loop' % subr)
+
+        return self.polynomial(subr).evaluate(self.check_values(values or {}))
+
+    def timing(self, subr, values=None):
+        """
+        Duration of a main or subroutine in microseconds, as in Sequencer.timing().
+        :param subr: name of main or subroutine
+        :param values: dict of pointer values (numbers or np.arrays)
+        :return:
+        """
+        return self.cycles(subr, values) * self.seq.parameters['clockperiod'] * 1e6
+
+    def dependencies(self, subr):
+        """
+        Repeat pointers the duration of a main or subroutine depends on.
+        :param subr:
+        :return: list
+        """
+        return self.polynomial(subr).variables()
+
+
+def print_model(seqfile, subr=None):
+    """
+    Prints the timing polynomials of a sequencer file, for one or all mains/subroutines.
+    :param seqfile:
+    :param subr: name of main or subroutine, all if None
+    :return:
+    """
+    import rebtxt
+    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False)
+    model = TimingModel(seq)
+
+    if subr is None:
+        names = sorted(seq.program.subroutines)
+    else:
+        names = [subr]
+
+    for name in names:
+        if model.is_infinite(name):
+            print("%s: infinite loop" % name)
+        else:
+            print("%s: %s cycles = %.2f us" % (name, model.polynomial(name), model.timing(name)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("timingmodel.py requires a sequencer file")
+        sys.exit()
+    seqfile = sys.argv[1]
+    if len(sys.argv) > 2:
+        subr = sys.argv[2]
+    else:
+        subr = None
+
+    print_model(seqfile, subr)
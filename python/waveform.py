@@ -0,0 +1,271 @@
+#! /usr/bin/env python
+#
+# LSST
+# Cycle-accurate simulation of the sequencer outputs for a whole main or subroutine.
+#
+# The result is a run-length encoded timeline of the 32 output lines, where repeated
+# functions and subroutines are kept as (repetitions, timeline) blocks: a full frame
+# readout (billions of 10 ns cycles) is simulated without ever expanding the repeats.
+#
+# Syntax in a script:
+# import rebtxt, waveform
+# seq = rebtxt.Sequencer.fromtxtfile("seq-newflush.txt", verbose=False)
+# tl = waveform.simulate(seq, "ReadFrame")
+# tl.total_time()                          # in clock cycles
+# tl.to_array(0, 10000, channels=[seq.channels['RG']])   # dense states over a window
+from __future__ import print_function
+import numpy as np
+
+from sequencer import ProgramVisitor
+
+
+class Repeat(object):
+    """
+    Block of a timeline repeated a number of times (None for infinite repetition).
+    """
+
+    def __init__(self, count, timeline):
+        self.count = count
+        self.timeline = timeline
+
+    def duration(self):
+        if self.count is None:
+            return float('inf')
+        return self.count * self.timeline.duration
+
+
+class Timeline(object):
+    """
+    Run-length encoded timeline of the 32 sequencer outputs.
+    Items are either runs [output word, duration in clock cycles] or Repeat blocks.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.duration = 0
+
+    def __repr__(self):
+        return "Timeline: %d items, %s cycles" % (len(self.items), self.duration)
+
+    def total_time(self):
+        """
+        Total duration (clock cycles), computed in closed form. Infinite if there is an infinite loop.
+        """
+        return self.duration
+
+    def append_run(self, output, duration):
+        """
+        Appends a run of constant outputs, merged with the previous one if identical.
+        :param output: 32 bits output word
+        :param duration: clock cycles
+        :return:
+        """
+        if duration <= 0:
+            return
+        if self.items and isinstance(self.items[-1], list) and self.items[-1][0] == output:
+            self.items[-1][1] += duration
+        else:
+            self.items.append([output, duration])
+        self.duration += duration
+
+    def append_repeat(self, count, timeline):
+        """
+        Appends count repetitions of the timeline (count None for an infinite loop).
+        The timeline is shared, not copied: it should not be modified afterwards.
+        :param count:
+        :param timeline: Timeline
+        :return:
+        """
+        if count is not None and (count <= 0 or timeline.duration == 0):
+            return
+
+        if count == 1:
+            for item in timeline.items:
+                if isinstance(item, list):
+                    self.append_run(item[0], item[1])
+                else:
+                    self.items.append(item)
+                    self.duration += item.duration()
+        elif count is not None and len(timeline.items) == 1 and isinstance(timeline.items[0], list):
+            # constant outputs: single longer run
+            self.append_run(timeline.items[0][0], count * timeline.duration)
+        else:
+            block = Repeat(count, timeline)
+            self.items.append(block)
+            self.duration += block.duration()
+
+    def iter_runs(self, start, stop, offset=0):
+        """
+        Generates the runs (start cycle, output, duration) overlapping [start, stop),
+        clipped to the window, expanding only the repetitions within the window.
+        Adjacent runs may have the same output (see runs() for merged ones).
+        """
+        for item in self.items:
+            if offset >= stop:
+                return
+            if isinstance(item, list):
+                output, duration = item
+                if offset + duration > start:
+                    first = max(offset, start)
+                    last = min(offset + duration, stop)
+                    yield first, output, last - first
+                offset += duration
+            else:
+                d = item.timeline.duration
+                total = item.duration()
+                if offset + total > start:
+                    # index of the first and last repetitions within the window
+                    kfirst = max(0, (start - offset) // d)
+                    klast = (min(stop, offset + total) - offset + d - 1) // d
+                    for k in range(int(kfirst), int(klast)):
+                        for run in item.timeline.iter_runs(start, stop, offset + k * d):
+                            yield run
+                offset += total
+
+    def runs(self, start=0, stop=None):
+        """
+        Merged runs (start cycle, output word, duration) within the window [start, stop).
+        :param start: clock cycle
+        :param stop: clock cycle (end of timeline if None)
+        :return: list
+        """
+        stop = self.check_window(start, stop)
+
+        merged = []
+        for first, output, duration in self.iter_runs(start, stop):
+            if merged and merged[-1][1] == output:
+                merged[-1][2] += duration
+            else:
+                merged.append([first, output, duration])
+
+        return [tuple(r) for r in merged]
+
+    def channel_runs(self, channel, start=0, stop=None):
+        """
+        Merged runs (start cycle, state, duration) for a single output line (bit number).
+        """
+        merged = []
+        for first, output, duration in self.runs(start, stop):
+            state = (output >> channel) & 1
+            if merged and merged[-1][1] == state:
+                merged[-1][2] += duration
+            else:
+                merged.append([first, state, duration])
+
+        return [tuple(r) for r in merged]
+
+    def output_at(self, cycle):
+        """
+        Output word at the given clock cycle.
+        """
+        for first, output, duration in self.iter_runs(cycle, cycle + 1):
+            return output
+
+        raise ValueError('Cycle %d is after end of timeline' % cycle)
+
+    def check_window(self, start, stop):
+        if stop is None:
+            stop = self.duration
+        if stop == float('inf'):
+            raise ValueError('Window must be bounded for a timeline with an infinite loop')
+        if start < 0 or stop < start:
+            raise ValueError('Invalid window [%d, %d)' % (start, stop))
+
+        return int(min(stop, self.duration))
+
+    def to_array(self, start=0, stop=None, channels=None):
+        """
+        Dense expansion of the window [start, stop), one item per clock cycle.
+        :param channels: list of output lines (bit numbers). If None, returns the output words.
+        :return: np.array, uint32 of shape (ncycles,) or uint8 of shape (nchannels, ncycles)
+        """
+        runs = self.runs(start, stop)
+        outputs = np.array([r[1] for r in runs], dtype=np.uint32)
+        durations = np.array([r[2] for r in runs], dtype=np.int64)
+        words = np.repeat(outputs, durations)
+
+        if channels is None:
+            return words
+
+        shifts = np.array(channels, dtype=np.uint32)[:, np.newaxis]
+        return ((words[np.newaxis, :] >> shifts) & 1).astype(np.uint8)
+
+
+def function_timeline(func):
+    """
+    Timeline of a single execution of a sequencer function, with the extra cycles
+    added by the FPGA to the first and last time slices (as in Function.scope()).
+    :param func: Function
+    :return: Timeline
+    """
+    timeline = Timeline()
+    tslices, durations = func.slice_durations()
+    for tslice, duration in zip(tslices, durations):
+        timeline.append_run(func.outputs.get(tslice, 0) & 0xffffffff, int(duration))
+
+    return timeline
+
+
+class SimulationVisitor(ProgramVisitor):
+    """
+    Builds the timeline of a subroutine, for simulate().
+    Timelines of functions and subroutines are built once and shared by all their calls.
+    """
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.function_timelines = {}
+        self.subroutine_timelines = {}
+        # one frame per subroutine level: [timeline, start address, repetitions]
+        self.frames = [[Timeline(), None, 1]]
+
+    def get_function_timeline(self, funcnum):
+        if funcnum not in self.function_timelines:
+            self.function_timelines[funcnum] = function_timeline(self.seq.functions[funcnum])
+        return self.function_timelines[funcnum]
+
+    def call_function(self, address, instr, funcnum, repetitions, level):
+        timeline = self.get_function_timeline(funcnum)
+        if instr.infinite_loop:
+            # nothing after this is ever executed
+            self.frames[-1][0].append_repeat(None, timeline)
+            return self.Stop
+        self.frames[-1][0].append_repeat(repetitions, timeline)
+
+    def enter_subroutine(self, address, instr, target_address, repetitions, level):
+        if target_address in self.subroutine_timelines:
+            self.frames[-1][0].append_repeat(repetitions, self.subroutine_timelines[target_address])
+            return self.Skip
+        self.frames.append([Timeline(), target_address, repetitions])
+
+    def leave_subroutine(self, address, instr, level):
+        if len(self.frames) > 1:
+            timeline, target_address, repetitions = self.frames.pop()
+            self.subroutine_timelines[target_address] = timeline
+            self.frames[-1][0].append_repeat(repetitions, timeline)
+
+    def result(self):
+        """
+        Timeline of the main, closing the subroutines left open by an infinite loop.
+        """
+        while len(self.frames) > 1:
+            timeline, target_address, repetitions = self.frames.pop()
+            self.frames[-1][0].append_repeat(1, timeline)
+
+        return self.frames[0][0]
+
+
+def simulate(seq, subr):
+    """
+    Simulates the execution of a main or subroutine, with the current values of the pointers.
+    :param seq: Sequencer
+    :param subr: name of main or subroutine
+    :return: Timeline
+    """
+    if subr not in seq.program.subroutines:
+        raise ValueError('Unknown subroutine name: %s' % subr)
+
+    visitor = SimulationVisitor(seq)
+    seq.walk(seq.program.subroutines[subr], visitor)
+
+    return visitor.result()